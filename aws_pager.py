@@ -17,6 +17,18 @@
 # for page in paginator.paginate(Bucket='scotts-mess'):
 #     for cur in page.get('Contents', []):
 #         print(cur['Key'])
+#
+# aws_pager_pages_prefetch works the same way as aws_pager_pages, but asks
+# for the next pages on a background thread while the caller is still working
+# through the current one, so the time waiting on AWS overlaps with the time
+# spent on the results.
+
+from utils import put_unless_stopped
+import queue
+import threading
+
+# How many pages to have waiting for the caller when prefetching
+PREFETCH_PAGES = 2
 
 # Returns an enumeration of all results from all pages as a tuple
 # where the first item is the result from results, and the second
@@ -29,6 +41,15 @@
 # for in each page
 # args and kwargs are the options to pass along to function
 def aws_pager(client, function, results, *args, **kwargs):
+    for page, _ in aws_pager_pages(client, function, results, *args, **kwargs):
+        for cur in page:
+            yield cur
+
+# The same as aws_pager, but returns one page at a time as a tuple of the list of
+# results from that page, and the arguments needed to pick up with the next page,
+# or None after the last page.  Passing those arguments along to a later call
+# will resume from that point.
+def aws_pager_pages(client, function, results, *args, **kwargs):
     # Get a function to call
     function = getattr(client, function)
 
@@ -40,21 +61,65 @@ def aws_pager(client, function, results, *args, **kwargs):
     # Loop through each page
     while True:
         resp = function(*args, **kwargs)
+        page = []
         for result in results:
             for cur in resp.get(result, []):
-                yield result, cur
-            
+                page.append((result, cur))
+
+        next_args = {}
         if 'NextContinuationToken' in resp:
             # Use the ContinuationToken format
-            kwargs['ContinuationToken'] = resp['NextContinuationToken']
+            next_args['ContinuationToken'] = resp['NextContinuationToken']
         elif 'NextToken' in resp:
             # Use the NextToken format
-            kwargs['NextToken'] = resp['NextToken']
+            next_args['NextToken'] = resp['NextToken']
         elif 'NextKeyMarker' in resp:
-            # Use the key marker format
-            kwargs['KeyMarker'] = resp['NextKeyMarker']
-        else:
+            # Use the key marker format, list_object_versions also needs the
+            # version marker, otherwise it starts over at the first version of
+            # the last key
+            next_args['KeyMarker'] = resp['NextKeyMarker']
+            if 'NextVersionIdMarker' in resp:
+                next_args['VersionIdMarker'] = resp['NextVersionIdMarker']
+
+        if len(next_args) == 0:
+            yield page, None
             break
+        yield page, next_args
+        kwargs.update(next_args)
+
+# The same as aws_pager_pages, but the pages are requested on a background
+# thread.  Up to prefetch pages are kept waiting, along with the one being
+# requested.  Any error the background thread hits is raised here, in place of
+# the page it was trying to get
+def aws_pager_pages_prefetch(client, function, results, *args, prefetch=PREFETCH_PAGES, **kwargs):
+    pages = queue.Queue(prefetch)
+    stop = threading.Event()
+
+    def send(item):
+        return put_unless_stopped(pages, item, stop)
+
+    def worker():
+        try:
+            for cur in aws_pager_pages(client, function, results, *args, **kwargs):
+                if not send((cur, None)):
+                    return
+            send((None, None))
+        except Exception as ex:
+            send((None, ex))
+
+    threading.Thread(target=worker, daemon=True).start()
+    try:
+        while True:
+            cur, error = pages.get()
+            if error is not None:
+                raise error
+            if cur is None:
+                break
+            yield cur
+    finally:
+        # If the caller stopped early, let the background thread know so it
+        # stops asking for more pages
+        stop.set()
 
 if __name__ == "__main__":
     print("This module is not meant to be called directly.")
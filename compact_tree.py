@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+from array import array
+from utils import PathCursor
+
+# A replacement for utils.Folder that uses much less memory.  Instead of an
+# object and a dictionary for each node, every node is a row in a handful of
+# flat arrays, along with a reference to its name.  Children are found with
+# an open addressing hash table, also stored in an array, keyed off of the
+# parent node and the name.
+#
+# It offers the same interface as Folder that the scanners and the layout
+# code use, the nodes handed out are small views into the arrays.
+
+class CompactNode:
+    # A view of a single node in a CompactFolder
+    __slots__ = ("tree", "idx")
+    def __init__(self, tree, idx):
+        self.tree = tree
+        self.idx = idx
+
+    @property
+    def count(self):
+        return self.tree.counts[self.idx]
+
+    @property
+    def size(self):
+        return self.tree.sizes[self.idx]
+
+    @property
+    def sub(self):
+        return CompactChildren(self.tree, self.idx)
+
+    def __getitem__(self, key):
+        return CompactNode(self.tree, self.tree._get_child(self.idx, key))
+
+    def __iter__(self):
+        return iter(self.sub.items())
+
+class CompactChildren:
+    # A read only view of the children of a node, acts like the dictionary in Folder.sub
+    __slots__ = ("tree", "idx")
+    def __init__(self, tree, idx):
+        self.tree = tree
+        self.idx = idx
+
+    def _children(self):
+        # New children are linked in at the front of the list, so reverse
+        # the list to return them in the order they were added, like Folder
+        tree, ret = self.tree, []
+        cur = tree.first_child[self.idx]
+        while cur >= 0:
+            ret.append(cur)
+            cur = tree.next_sibling[cur]
+        return reversed(ret)
+
+    def __len__(self):
+        return len(list(self._children()))
+
+    def __getitem__(self, key):
+        idx = self.tree._find_child(self.idx, key)
+        if idx < 0:
+            raise KeyError(key)
+        return CompactNode(self.tree, idx)
+
+    def __contains__(self, key):
+        return self.tree._find_child(self.idx, key) >= 0
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        names = self.tree.names
+        for cur in self._children():
+            yield names[cur]
+
+    def values(self):
+        for cur in self._children():
+            yield CompactNode(self.tree, cur)
+
+    def items(self):
+        names = self.tree.names
+        for cur in self._children():
+            yield names[cur], CompactNode(self.tree, cur)
+
+class CompactFolder(CompactNode):
+    # The root of the tree, this owns all of the storage
+    __slots__ = ("opts", "parents", "names", "first_child", "next_sibling", "counts", "sizes", "table", "mask", "cursor")
+    def __init__(self, opts):
+        super().__init__(self, 0)
+        self.opts = opts
+        # One entry in each of these for each node, node 0 is the root.  The links
+        # between nodes are 32-bit, which is enough for two billion nodes
+        self.parents = array('i', [-1])
+        self.names = [None]
+        self.first_child = array('i', [-1])
+        self.next_sibling = array('i', [-1])
+        self.counts = array('q', [0])
+        # Sizes start out as integers, but switch to floats if any floats are added
+        self.sizes = array('q', [0])
+        # Open addressing hash table from (parent, name) to the child node
+        self.table = array('i', [-1]) * 1024
+        self.mask = len(self.table) - 1
+        # The path of the last item added, and the nodes along that path
+        self.cursor = PathCursor(0)
+
+    def _slot(self, parent, key):
+        # Find the slot in the hash table for this parent and name, either the
+        # slot with the node, or the empty slot where it would be stored
+        table, parents, names, mask = self.table, self.parents, self.names, self.mask
+        slot = ((parent * 1000003) ^ hash(key)) & mask
+        while True:
+            cur = table[slot]
+            if cur < 0 or (parents[cur] == parent and names[cur] == key):
+                return slot
+            slot = (slot + 1) & mask
+
+    def _find_child(self, parent, key):
+        return self.table[self._slot(parent, key)]
+
+    def _get_child(self, parent, key):
+        # Find a child node, creating it if it doesn't exist yet
+        slot = self._slot(parent, key)
+        idx = self.table[slot]
+        if idx < 0:
+            idx = len(self.parents)
+            self.parents.append(parent)
+            self.names.append(key)
+            self.next_sibling.append(self.first_child[parent])
+            self.first_child[parent] = idx
+            self.first_child.append(-1)
+            self.counts.append(0)
+            self.sizes.append(0)
+            self.table[slot] = idx
+            if len(self.parents) * 2 > len(self.table):
+                self._grow()
+        return idx
+
+    def _grow(self):
+        # Double the size of the hash table, and put all the nodes back in it
+        self.table = array('i', [-1]) * (len(self.table) * 2)
+        self.mask = len(self.table) - 1
+        for idx in range(1, len(self.parents)):
+            self.table[self._slot(self.parents[idx], self.names[idx])] = idx
+
+    def _add_totals(self, idx, count, size):
+        self.counts[idx] += count
+        try:
+            self.sizes[idx] += size
+        except TypeError:
+            # This is the first non-integer size, like a cost, so store floats from now on
+            self.sizes = array('d', self.sizes)
+            self.sizes[idx] += size
+
+    def _find(self, path, stop):
+        # Same as Folder._find, find the node for path[:stop], creating it if needed
+        return self.cursor.find(path, stop, self._get_child)
+
+    def add(self, filename, size):
+        # Same as Folder.add, find the node for this object, and add it to the totals
+        if isinstance(size, tuple):
+            size, count = size
+        else:
+            count = 1
+        self._add_totals(self._find(filename, len(filename) - (0 if self.opts["per_object"] else 1)), count, size)
+
+    def add_dir(self, path, count, size):
+        self._add_totals(self._find(path, len(path)), count, size)
+
+    def add_row(self, row):
+        if len(row) == 3:
+            self.add_dir(*row)
+        else:
+            self.add(*row)
+
+    def sum_up(self):
+        # Children are always created after their parent, so walking backwards
+        # sees every child before its parent
+        parents, counts, sizes = self.parents, self.counts, self.sizes
+        for idx in range(len(parents) - 1, 0, -1):
+            parent = parents[idx]
+            counts[parent] += counts[idx]
+            sizes[parent] += sizes[idx]
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
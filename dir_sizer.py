@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
+from compact_tree import CompactFolder
 from datetime import datetime
 from grid_layout import get_webpage, get_image, AUTO_SCALE, SET_SIZE
-from utils import hide_value, Folder, BatchingSql, ALL_ABSTRACTIONS
+from scan_cache import open_cache, cache_init, cache_add, cache_find, cache_finish, cache_get, cache_get_subset, cache_get_tree, cache_query, cache_save_tree
+from tree_snapshot import load_snapshot, load_snapshot_meta, save_snapshot
+from utils import hide_value, Folder, ALL_ABSTRACTIONS
 import json
 import os
-import sqlite3
 import sys
 import textwrap
 if sys.version_info >= (3, 11): from datetime import UTC
@@ -50,9 +52,18 @@ def set_hide_names(opts, args):
     opts['hide_names'] = True
     return args
 
+def set_hide_key(opts, args):
+    if len(args) > 0:
+        opts['hide_key'] = args[0].encode("utf-8")
+        return args[1:]
+    else:
+        print("ERROR: No key for --hide_key specified")
+        opts['show_help'] = True
+        return args
+
 def set_cache_id(opts, args):
     if len(args) > 0:
-        db = sqlite3.connect(opts['cache'])
+        db = open_cache(opts['cache'])
         target_id = int(args[0])
         args = args[1:]
         for flags, in db.execute("SELECT flags FROM options WHERE valid = 1 AND id = ?;", (target_id,)):
@@ -107,6 +118,49 @@ def set_cache_dir(opts, args):
         opts['show_help'] = True
         return args
 
+def set_save_snapshot(opts, args):
+    if len(args) > 0:
+        opts['save_snapshot'] = args[0]
+        return args[1:]
+    else:
+        print("ERROR: No filename for --save_snapshot specified")
+        opts['show_help'] = True
+        return args
+
+def set_load_snapshot(opts, args):
+    if len(args) > 0:
+        opts['load_snapshot'] = args[0]
+        try:
+            meta = load_snapshot_meta(args[0])
+        except OSError as e:
+            print(f"ERROR: Unable to read snapshot {args[0]}: {e.strerror}")
+            opts['show_help'] = True
+            return args[1:]
+        except Exception:
+            # Not a snapshot, or it's been cut short
+            meta = None
+        if not isinstance(meta, dict) or any(x not in meta for x in ("flags", "per_object", "hide_names")):
+            print(f"ERROR: {args[0]} is not a valid tree snapshot")
+            opts['show_help'] = True
+            return args[1:]
+        args = args[1:]
+        # Restore the options the snapshot was created with
+        for key, value in meta['flags'].items():
+            if key == "target_switch":
+                args.append(value)
+            else:
+                opts[key] = value
+        for key, value in meta.get('render_flags', {}).items():
+            opts[key] = value
+        opts['per_object'] = meta['per_object']
+        opts['hide_names'] = meta['hide_names']
+        opts['class_totals'] = meta.get('class_totals', {})
+        return args
+    else:
+        print("ERROR: No filename for --load_snapshot specified")
+        opts['show_help'] = True
+        return args
+
 def set_debug(opts, args):
     opts['debug'] = True
     return args
@@ -115,6 +169,10 @@ def set_per_object(opts, args):
     opts['per_object'] = True
     return args
 
+def set_compact_tree(opts, args):
+    opts['compact_tree'] = True
+    return args
+
 def set_no_output(opts, args):
     if opts['output_mode'] is not None:
         print("ERROR: Output already specified")
@@ -123,13 +181,45 @@ def set_no_output(opts, args):
     opts['output_mode'] = 'none'
     return args
 
+def set_query(opts, args):
+    if len(args) > 0:
+        if opts['output_mode'] is not None:
+            print("ERROR: Output already specified")
+            opts['show_help'] = True
+            return args
+        opts['query'] = args[0]
+        opts['output_mode'] = 'query'
+        return args[1:]
+    else:
+        print("ERROR: No path for --query specified")
+        opts['show_help'] = True
+        return args
+
+def set_top(opts, args):
+    if len(args) > 0 and args[0].isdigit():
+        opts['query_top'] = int(args[0])
+        return args[1:]
+    else:
+        print("ERROR: No count for --top specified")
+        opts['show_help'] = True
+        return args
+
 def get_abstraction_flags(opts):
     ret = {}
+    # Some flags only change how a scan is performed, or how the results are
+    # shown, ignore them
+    ignored = getattr(opts['target'], "RUNTIME_FLAGS", set()) | getattr(opts['target'], "RENDER_FLAGS", set())
     for key, value in opts.items():
         if key == "target_switch" or key.startswith(opts['target_prefix']):
-            ret[key] = value
+            if key not in ignored:
+                ret[key] = value
     return ret
 
+def get_render_flags(opts):
+    # The flags that change how the results of a scan are shown
+    render_flags = getattr(opts['target'], "RENDER_FLAGS", set())
+    return {x: y for x, y in opts.items() if x in render_flags}
+
 def main():
     args = sys.argv[1:]
     opts = {
@@ -142,6 +232,13 @@ def main():
         'debug': False,
         'per_object': False,
         'hide_names': False,
+        'compact_tree': False,
+        'save_snapshot': None,
+        'load_snapshot': None,
+        'query': None,
+        'query_top': 50,
+        # Details the scanner noted while scanning, stored with the cached results
+        'scan_meta': {},
     }
 
     flags = {
@@ -153,7 +250,14 @@ def main():
         '--cache_dir': set_cache_dir,
         '--cache_id': set_cache_id,
         '--hide_names': set_hide_names,
+        '--hide_key': set_hide_key,
         '--debug': set_debug,
+        '--per_object': set_per_object,
+        '--compact_tree': set_compact_tree,
+        '--save_snapshot': set_save_snapshot,
+        '--load_snapshot': set_load_snapshot,
+        '--query': set_query,
+        '--top': set_top,
     }
 
     if len(sys.argv) == 1:
@@ -188,7 +292,7 @@ def main():
 
     if opts['cache_opts']:
         if opts['cache'] is not None:
-            db = sqlite3.connect(opts['cache'])
+            db = open_cache(opts['cache'])
             for id, flags in db.execute("SELECT id, flags FROM options WHERE valid = 1;"):
                 print(f"Cached info #{id}:")
                 print(json.dumps(json.loads(flags), indent=4))
@@ -205,17 +309,39 @@ def main():
         print("ERROR: No output specified")
         opts['show_help'] = True
 
+    if not opts['show_help'] and opts['output_mode'] == 'query' and opts['cache'] is None:
+        print("ERROR: --query needs a --cache file to look in")
+        opts['show_help'] = True
+
+    if opts['hide_names'] and 'hide_key' not in opts:
+        # A fixed default key would let anyone check a guess at a hidden name,
+        # so without a key from the user, use one that's only known to this run
+        opts['hide_key'] = os.urandom(32)
+
+    if not opts['show_help'] and hasattr(opts['target'], "check_args"):
+        # Let the scanner check its options against the rest, since those can
+        # come after the scanner's own options
+        opts['target'].check_args(opts)
+
     if opts['debug']:
         print(textwrap.dedent("""
             Debug options:
 
-            --cache <value>     = Store and use cache of files in <value> file
-            --cache_opts        = Show flags stored in cache database file
-            --cache_id <id>     = Load cache data via ID #<id>
-            --cache_dir <value> = Create a new cache file in <value> directory with 
-                                  the current timestamp
-                                  Note that one cache file can store different options
-            --hide_names        = Hide all names, replace them with fake names
+            --cache <value>         = Store and use cache of files in <value> file
+            --cache_opts            = Show flags stored in cache database file
+            --cache_id <id>         = Load cache data via ID #<id>
+            --cache_dir <value>     = Create a new cache file in <value> directory with 
+                                      the current timestamp
+                                      Note that one cache file can store different options
+            --hide_names            = Hide all names, replace them with fake names
+            --hide_key <value>      = Key used to pick the fake names for --hide_names,
+                                      the same key always gives the same names.
+                                      Without it a random key is used for each run
+            --save_snapshot <value> = Save the final tree to a binary snapshot file
+            --load_snapshot <value> = Use the tree in a snapshot file instead of scanning
+            --query <value>         = Show the size of the <value> path, and its largest
+                                      children, from the --cache file without scanning
+            --top <value>           = Number of children to show for --query, defaults to 50
         """))
         exit(1)
 
@@ -227,6 +353,8 @@ def main():
             --output_image <value> = Filename to output image to
             --no_output            = Don't create any output file
             --per_object           = Show each object as a seperate box
+            --compact_tree         = Store the results in a tree that uses much less
+                                     memory, but is slower to build
             --debug                = Show some additional options useful for debugging
         """))
         for cur in ALL_ABSTRACTIONS:
@@ -237,12 +365,25 @@ def main():
             print("")
         exit(1)
 
-    folder = Folder(opts)
     abstraction = opts['target']
 
-    for filename, size in load_files(opts, abstraction):
-        folder.add(filename, size)
-    folder.sum_up()
+    if opts['output_mode'] == 'query':
+        show_query(opts, abstraction)
+        exit(0)
+
+    if opts['load_snapshot'] is not None:
+        folder = load_snapshot(opts['load_snapshot'])
+    else:
+        folder = load_tree(opts, abstraction)
+
+    if opts['save_snapshot'] is not None:
+        save_snapshot(folder, opts['save_snapshot'], {
+            "flags": get_abstraction_flags(opts),
+            "render_flags": get_render_flags(opts),
+            "per_object": opts['per_object'],
+            "hide_names": opts['hide_names'],
+            "class_totals": opts.get('class_totals', {}),
+        })
 
     if opts['output_mode'] == 'html':
         with open(opts['output'], "wt", newline="\n", encoding="utf-8") as f:
@@ -260,58 +401,123 @@ def main():
         raise Exception("ERROR: Unknown output mode!")
 
 
-def cache_init(opts, flags):
-    known_id, valid = None, False
-    if opts['cache'] is not None:
-        opts['cache_db'] = sqlite3.connect(opts['cache'])
-        opts['cache_db'].execute("CREATE TABLE IF NOT EXISTS options(id INTEGER PRIMARY KEY AUTOINCREMENT, flags TEXT NOT NULL, valid INT NOT NULL);")
-        opts['cache_db'].execute("CREATE UNIQUE INDEX IF NOT EXISTS options_flags_idx ON options(flags);")
-        opts['cache_db'].execute("CREATE TABLE IF NOT EXISTS files(id INT NOT NULL, name NOT NULL, size NOT NULL);")
-        opts['cache_db'].execute("CREATE INDEX IF NOT EXISTS files_id_idx ON files(id);")
-        opts['cache_db'].commit()
-        flags = json.dumps(flags, sort_keys=True)
-        for row in opts['cache_db'].execute("SELECT id, valid FROM options WHERE flags = ?;", (flags,)):
-            known_id, valid = row[0], row[1] == 1
-        if known_id is None:
-            cur = opts['cache_db'].execute("INSERT INTO options(flags, valid) VALUES (?, 0);", (flags,))
-            opts['cache_db'].commit()
-            known_id = cur.lastrowid
-        elif not valid:
-            opts['cache_db'].execute("DELETE FROM files WHERE id = ?;", (known_id,))
-            opts['cache_db'].commit()
-            valid = False
-        if not valid:
-            opts['cache_sql'] = BatchingSql(opts['cache_db'], f"INSERT INTO files(id, name, size) VALUES ({known_id}, ?, ?);")
-    return known_id, valid
-
-def cache_add(opts, name, size):
-    opts['cache_sql'].execute(json.dumps(name), size)
-
-def cache_finish(opts, known_id):
-    opts['cache_sql'].finish()
-    opts['cache_db'].execute("UPDATE options SET valid=1 WHERE id=?;", (known_id,))
-    opts['cache_db'].commit()
-
-def cache_get(opts, known_id):
-    for name, size in opts['cache_db'].execute("SELECT name, size FROM files WHERE id = ?;", (known_id,)):
-        yield json.loads(name), size
-
-def load_files(opts, abstraction):
+def show_query(opts, abstraction):
+    if len(get_render_flags(opts)) > 0:
+        # The totals in the cache are only sizes, as they were scanned
+        print("ERROR: --query can't be used with options that change how sizes are shown")
+        exit(1)
+    opts['cache_db'] = open_cache(opts['cache'])
+    found = cache_find(opts, get_abstraction_flags(opts))
+    if found is None:
+        print("ERROR: No finished scan in the cache for these options")
+        exit(1)
+    known_id, path = found
+
+    query = abstraction.split(opts['query']) if len(opts['query']) > 0 else []
+    if len(query) > 0 and query[-1] == "":
+        # Allow a trailing separator on the path
+        query.pop()
+    result = cache_query(opts, known_id, path + query, opts['query_top'])
+    if result is None:
+        print(f"ERROR: {opts['query']} was not found in the cache")
+        exit(1)
+
+    count, size, children = result
+    print(f"{opts['query']}: {abstraction.dump_size(opts, size)} in {abstraction.dump_count(opts, count)} objects")
+    rows = []
+    for name, is_dir, sub_count, sub_size in children:
+        if name is None:
+            name = "(objects in this folder)"
+        elif is_dir:
+            name = abstraction.join([name, ""])
+        rows.append((abstraction.dump_size(opts, sub_size), abstraction.dump_count(opts, sub_count), name))
+    if len(rows) > 0:
+        size_width = max(len(x[0]) for x in rows)
+        count_width = max(len(x[1]) for x in rows)
+        for sub_size, sub_count, name in rows:
+            print(f"    {sub_size:>{size_width}}  {sub_count:>{count_width}}  {name}")
+
+def load_tree(opts, abstraction):
     if opts['cache'] is not None:
         known_id, valid = cache_init(opts, get_abstraction_flags(opts))
     else:
         known_id, valid = None, False
 
-    if valid:
-        for filename, size in cache_get(opts, known_id):
-            yield filename, size
+    # If the cache has the tree already summed up, there's no need to look at each
+    # row, as long as it was summed up to be shown the same way
+    if valid and opts.get('cache_subset') is None:
+        folder = cache_get_tree(opts, known_id)
+        if folder is not None and folder.meta.get('render_flags', {}) == get_render_flags(opts):
+            opts['class_totals'] = folder.meta.get('class_totals', {})
+            return folder
+
+    if opts['compact_tree']:
+        folder = CompactFolder(opts)
+    else:
+        folder = Folder(opts)
+
+    opts['class_totals'] = {}
+    for row in weigh_rows(opts, abstraction, load_files(opts, abstraction, known_id, valid)):
+        folder.add_row(row)
+    folder.sum_up()
+
+    if known_id is not None and opts.get('cache_subset') is None:
+        cache_save_tree(opts, known_id, folder, {
+            "render_flags": get_render_flags(opts),
+            "class_totals": opts['class_totals'],
+        })
+    return folder
+
+def weigh_rows(opts, abstraction, rows):
+    # Rows can also be (path, count, size, class), with a count of None for a
+    # single object, when the scanner tracks a class for each object, like a S3
+    # storage class.  Those are turned into plain rows here, so the tree only has
+    # what's being shown, the abstraction decides how much each byte in a class
+    # counts for, like its price, or None to leave the class out.  The totals
+    # for each class are kept in opts['class_totals'] as [count, size]
+    get_weight = None
+    weights = {}
+    totals = opts['class_totals']
+    for row in rows:
+        if len(row) == 4:
+            path, count, size, row_class = row
+            if row_class not in weights:
+                if get_weight is None:
+                    get_weight = abstraction.get_class_weights(opts)
+                weights[row_class] = get_weight(row_class)
+                totals[row_class] = [0, 0]
+            totals[row_class][0] += 1 if count is None else count
+            totals[row_class][1] += size
+            weight = weights[row_class]
+            if weight is None:
+                continue
+            if weight != 1:
+                size *= weight
+            row = (path, size) if count is None else (path, count, size)
+        yield row
+
+def load_files(opts, abstraction, known_id, valid):
+    # Each row is either (path, size) for a single object, or (path, count, size)
+    # for the total of the objects directly inside of a folder, see weigh_rows
+    # for rows with a class
+    if valid and opts.get('cache_subset') is not None:
+        # Only part of another scan's results are needed
+        for row in cache_get_subset(opts, known_id, opts['cache_subset']):
+            yield row
+    elif valid:
+        for row in cache_get(opts, known_id):
+            yield row
     else:
-        for filename, size in abstraction.scan_folder(opts):
+        if opts.get('cache_resume') is not None:
+            # Resuming an earlier scan, so start with the rows it already stored
+            for row in cache_get(opts, known_id):
+                yield row
+        for row in abstraction.scan_folder(opts):
             if opts['hide_names']:
-                filename = hide_value(opts, filename)
-            yield filename, size
+                row = (hide_value(opts, row[0]),) + row[1:]
+            yield row
             if known_id is not None:
-                cache_add(opts, filename, size)
+                cache_add(opts, row)
         if known_id is not None:
             cache_finish(opts, known_id)
 
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from utils import TempMessage, size_to_string, count_to_string, register_abstraction
+from utils import Progress, flags_match_except, size_to_string, count_to_string, register_abstraction
 try:
     # Wrap the use of the Google Cloud SDK in a try/except block
     # so if it's not available, the rest will work
@@ -50,9 +50,21 @@ def get_help():
         WARNING: google-cloud-storage import failed, module will not work correctly!
     """)
 
+def get_cache_subset(flags, cached):
+    # A cached scan of the same bucket with a prefix that this prefix starts with
+    # has every blob this scan would find.  Blob names are stored in full, so
+    # they're used as is
+    if not flags_match_except(flags, cached, 'gcloud_prefix'):
+        return None
+    prefix, cached_prefix = flags.get('gcloud_prefix', ''), cached.get('gcloud_prefix', '')
+    if not prefix.startswith(cached_prefix):
+        return None
+    parts = prefix.split("/")
+    return parts[:-1], parts[-1], False
+
 def scan_folder(opts):
-    msg = TempMessage()
-    msg("Scanning...", force=True)
+    progress = Progress(dump_size=lambda value: dump_size(opts, value))
+    progress.start()
 
     # Connect to the remote machine
     if 'gcloud_project' in opts:
@@ -60,19 +72,24 @@ def scan_folder(opts):
     else:
         sc = storage.Client()
 
-    total_objects = 0
-    total_size = 0
-
-    for i, blob in enumerate(sc.list_blobs(opts['gcloud_bucket'], prefix=opts['gcloud_prefix'] if 'gcloud_prefix' in opts else None)):
-        size = blob.size
-        name = blob.name
-        total_objects += 1
-        total_size += size
-        yield name.split("/"), size
-        if i % 1000 == 999:
-            msg(f"Scanning, gathered {total_objects} totaling {dump_size(opts, total_size)}...")
-
-    msg(f"Done, saw {total_objects} totaling {dump_size(opts, total_size)}", newline=True)
+    # When resuming an interrupted scan, pick up with the page it was about to request
+    page_token = None
+    if opts.get('cache_resume') is not None:
+        page_token = opts['cache_resume']['gcloud_page_token']
+    checkpoint = opts.get('cache_checkpoint')
+
+    blobs = sc.list_blobs(opts['gcloud_bucket'], prefix=opts['gcloud_prefix'] if 'gcloud_prefix' in opts else None, page_token=page_token)
+    for page in blobs.pages:
+        for blob in page:
+            size = blob.size
+            name = blob.name
+            progress.add(1, size)
+            yield name.split("/"), size
+        # The iterator has the token for the next page once this page is done
+        if checkpoint is not None and blobs.next_page_token is not None:
+            checkpoint(lambda: {'gcloud_page_token': blobs.next_page_token})
+
+    progress.stop()
 
 def split(path):
     # Hardcoded to use forward slashes
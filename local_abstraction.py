@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 
 from collections import deque
-from utils import TempMessage, size_to_string, count_to_string, register_abstraction
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from utils import Folder, JobQueue, Progress, flags_match_except, size_to_string, count_to_string, register_abstraction
+import json
 import os
 import stat
+import time
 import platform
 register_abstraction(__name__)
 
 MAIN_SWITCH = "--local"
 FLAG_PREFIX = "lfs_"
 DESCRIPTION = "Scan local file system"
+# Flags that change how the scan is run, but not what it finds, these
+# aren't used to tell cached scans apart
+RUNTIME_FLAGS = {"lfs_threads", "lfs_processes", "lfs_incremental"}
 
 def handle_args(opts, args):
     while not opts['show_help']:
@@ -22,20 +29,67 @@ def handle_args(opts, args):
         elif len(args) >= 1 and args[0] == "--follow_mounts":
             opts['lfs_follow_mounts'] = True
             args = args[1:]
+        elif len(args) >= 1 and args[0] == "--incremental":
+            opts['lfs_incremental'] = True
+            # Always scan again, even if there's a valid cache
+            opts['cache_refresh'] = True
+            args = args[1:]
+        elif len(args) >= 2 and args[0] == "--threads":
+            if not args[1].isdigit() or int(args[1]) < 1:
+                opts['show_help'] = True
+                print("ERROR: --threads needs to be a number of at least 1")
+            else:
+                opts['lfs_threads'] = int(args[1])
+                args = args[2:]
+        elif len(args) >= 2 and args[0] == "--processes":
+            if not args[1].isdigit() or int(args[1]) < 1:
+                opts['show_help'] = True
+                print("ERROR: --processes needs to be a number of at least 1")
+            else:
+                opts['lfs_processes'] = int(args[1])
+                args = args[2:]
         else:
             break
     
     if not opts['show_help'] and 'lfs_base' not in opts:
         opts['show_help'] = True
         print("ERROR: No base path specified for local file system")
+
+    if not opts['show_help']:
+        exclusive = [
+            ['threads', ['processes', 'incremental']],
+            ['processes', ['incremental']],
+        ]
+
+        for opt_a, opts_b in exclusive:
+            for opt_b in opts_b:
+                if ('lfs_' + opt_a) in opts and ('lfs_' + opt_b) in opts:
+                    opts['show_help'] = True
+                    print(f"ERROR: Both {opt_a} and {opt_b} specified, options are mutually exclusive")
     
     return args
 
+def check_args(opts):
+    # Checks for options that depend on the options outside of this scanner
+    if opts.get('lfs_incremental', False):
+        if opts['cache'] is None:
+            opts['show_help'] = True
+            print("ERROR: --incremental needs a --cache file to store details in")
+        elif opts['per_object']:
+            opts['show_help'] = True
+            print("ERROR: Both incremental and per_object specified, options are mutually exclusive")
+
 def get_help():
     return """
-        --base <value>  = Base path to scan for files
-        --follow_links  = Follow into links and junctions (optional)
-        --follow_mounts = Follow into mount points (optional)
+        --base <value>      = Base path to scan for files
+        --follow_links      = Follow into links and junctions (optional)
+        --follow_mounts     = Follow into mount points (optional)
+        --threads <value>   = Number of directories to scan at once (optional)
+        --processes <value> = Number of processes to split the scan across (optional)
+        --incremental       = Only scan directories that changed since the last scan
+                              stored in --cache (optional)
+                              Note: Files changed in place without being renamed
+                              aren't noticed
     """
 
 # ----- SCANNER_START ---------------------------------------------------------
@@ -43,6 +97,7 @@ def get_help():
 # pulled out and used by the SSH abstraction.  This is done to prevent two
 # blocks of code that do the same thing.
 import os
+import platform
 import stat
 from collections import deque
 
@@ -65,80 +120,327 @@ def is_link(dn):
             # It's something else, either a raw file, or directory
             return False
 
-def scan_folder(opts):
-    msg = TempMessage()
-    msg("Scanning...", force=True)
-
-    # Scan all folders under the selected path
-    total_objects, total_size = 0, 0
+def get_scan_settings(opts):
+    # Work out the starting point, and the device and platform details
+    # used to decide which directories to skip
     # Use expanduser to allow things like "~/"
-    todo = deque([(os.path.expanduser(opts['lfs_base']), [])])
+    base = os.path.expanduser(opts['lfs_base'])
 
     target_dev = None
     if not opts.get("lfs_follow_mounts", False):
-        target_dev = os.stat(os.path.expanduser(opts['lfs_base'])).st_dev
+        target_dev = os.stat(base).st_dev
 
     is_darwin = False
     if platform.system() == 'Darwin':
         is_darwin = True
 
+    return base, target_dev, is_darwin
+
+def scan_dir(opts, path, path_parts, target_dev, is_darwin):
+    # Scan a single directory, returning a list of the (name, size) of each file
+    # in it, and a list of the sub-directories that should be scanned
+    files, dirs = [], []
+    # Use scandir instead of other options to force FindFirstFile on Windows
+    # for a considerable speedup.  These functions aren't recursive on their
+    # own, so the callers track directories and recurse manually.
+    # Order here isn't important, it'll be sorted elsewhere, so whatever scandir
+    # returns in is fine.
+    follow_links = opts.get("lfs_follow_links", False)
+    follow_mounts = opts.get("lfs_follow_mounts", False)
+    try:
+        for cur in os.scandir(path):
+            try:
+                # scandir already knows the type of each entry on most platforms, so
+                # use that to decide what this is, and only stat when the size or
+                # device is really needed.  DirEntry caches stat calls, so asking
+                # for the same details more than once is free.
+                if cur.is_symlink():
+                    # Links need to be followed to see what they point to, this
+                    # will throw for dangling links, which are ignored
+                    is_dir = stat.S_ISDIR(cur.stat().st_mode)
+                    # We shouldn't follow into links, so don't use it
+                    use_entry = follow_links or not is_dir
+                elif cur.is_dir(follow_symlinks=False):
+                    is_dir = True
+                    use_entry = True
+                    if not follow_links and os.name == "nt":
+                        # Junctions on Windows aren't reported as symbolic links, so
+                        # fall back to checking for them directly
+                        if is_link(cur.path):
+                            use_entry = False
+                else:
+                    is_dir = False
+                    use_entry = True
+
+                if use_entry and not follow_mounts:
+                    # We shouldn't follow into mount points, so see if this entry is on the same device
+                    if cur.stat().st_dev != target_dev:
+                        # It's on a different device, ignore it
+                        use_entry = False
+                if use_entry and is_dir and is_darwin and not follow_mounts:
+                    # This directory is the root of the firmlinks on Darwin, ignore this
+                    if cur.path.startswith("/System/Volumes"):
+                        use_entry = False
+
+                if use_entry:
+                    if is_dir:
+                        # It's a directory, add it to our list ot do
+                        dirs.append((cur.path, path_parts + [cur.name]))
+                    else:
+                        # It's a file, add it to the list to send out
+                        files.append((cur.name, cur.stat().st_size))
+            except (FileNotFoundError, OSError, PermissionError):
+                # Ignore any files we don't see (mostly dangling links)
+                # Also ignore any permission errors
+                pass
+    except (FileNotFoundError, OSError, PermissionError):
+        # And ignore any errors on the scandir itself, do this
+        # in to seperate try/except blocks so any errors on a single
+        # file don't break an entire folder
+        pass
+    return files, dirs
+
+def get_rows(opts, path_parts, files):
+    # Turn the files found in one directory into rows to send out, either one
+    # row per object, or a single row with the totals for the directory
+    if opts.get('per_object', False):
+        return [(path_parts + [name], size) for name, size in files]
+    elif len(files) > 0:
+        return [(path_parts, len(files), sum(size for _, size in files))]
+    else:
+        return []
+
+def get_resume_todo(opts, base):
+    # The directories left to scan, either all of them, or when resuming an
+    # interrupted scan, the ones it hadn't finished.  Every entry is a directory
+    # none of which, including anything under it, has been sent out yet
+    resume = opts.get('cache_resume')
+    if resume is None:
+        return [(base, [])]
+    return [(path, path_parts) for path, path_parts in resume['todo']]
+
+def walk_folder(opts):
+    progress = Progress()
+    progress.start()
+
+    # Scan all folders under the selected path
+    base, target_dev, is_darwin = get_scan_settings(opts)
+    todo = deque(get_resume_todo(opts, base))
+    checkpoint = opts.get('cache_checkpoint')
+
+    while len(todo) > 0:
+        if checkpoint is not None:
+            # Everything sent out so far has been handled, so this is a spot the
+            # scan can be resumed from
+            checkpoint(lambda: {'todo': list(todo)})
+        path, path_parts = todo.pop()
+        files, dirs = scan_dir(opts, path, path_parts, target_dev, is_darwin)
+        todo.extend(dirs)
+        for row in get_rows(opts, path_parts, files):
+            progress.add(1 if len(row) == 2 else row[1], row[-1])
+            yield row
+    progress.stop()
+# ----- SCANNER_END -----------------------------------------------------------
+
+def walk_folder_threaded(opts):
+    # The same walk as walk_folder, but with a pool of workers each scanning one
+    # directory at a time, which lets slow storage work on many requests at once
+    progress = Progress()
+    progress.start()
+
+    base, target_dev, is_darwin = get_scan_settings(opts)
+
+    # Each worker scans one directory, the results are only ever handed out
+    # from this thread, so the output is the same stream as walk_folder
+    def scan_job(job):
+        path, path_parts = job
+        files, dirs = scan_dir(opts, path, path_parts, target_dev, is_darwin)
+        return get_rows(opts, path_parts, files), dirs
+
+    pool = ThreadPoolExecutor(opts['lfs_threads'])
+    jobs = JobQueue(pool, scan_job)
+    try:
+        for job in get_resume_todo(opts, base):
+            jobs.add(job)
+        for _, (rows, dirs) in jobs.results(opts.get('cache_checkpoint')):
+            for job in dirs:
+                jobs.add(job)
+            for row in rows:
+                progress.add(1 if len(row) == 2 else row[1], row[-1])
+                yield row
+    finally:
+        # If the caller stopped early, don't bother scanning what's left
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    progress.stop()
+
+def scan_shard(job):
+    # Runs on a worker process, scan one sub-tree and total it up into a
+    # Folder, so only the per-folder totals need to be sent back.  With
+    # per_object, each object is its own row, so those are sent back as is
+    opts, shard, shard_parts, target_dev, is_darwin = job
+    rows = []
+    folder = None if opts['per_object'] else Folder(opts)
+    todo = deque([(shard, shard_parts)])
+    while len(todo) > 0:
+        path, path_parts = todo.pop()
+        files, dirs = scan_dir(opts, path, path_parts, target_dev, is_darwin)
+        todo.extend(dirs)
+        for row in get_rows(opts, path_parts, files):
+            if folder is None:
+                rows.append(row)
+            else:
+                folder.add_row(row)
+    return shard, rows if folder is None else list(folder.walk())
+
+def walk_folder_processes(opts):
+    # Split the tree into shards, and scan each shard on a different process.
+    # Each process builds up the totals for its shard, and those totals are
+    # passed along to be merged into the final tree
+    progress = Progress()
+    progress.start()
+
+    base, target_dev, is_darwin = get_scan_settings(opts)
+
+    # Walk the top of the tree breadth first, until there are enough directories
+    # to keep every process busy even if some of the shards are small
+    shards = deque(get_resume_todo(opts, base))
+    checkpoint = opts.get('cache_checkpoint')
+    while 0 < len(shards) < opts['lfs_processes'] * 8:
+        if checkpoint is not None:
+            checkpoint(lambda: {'todo': list(shards)})
+        path, path_parts = shards.popleft()
+        files, dirs = scan_dir(opts, path, path_parts, target_dev, is_darwin)
+        shards.extend(dirs)
+        for row in get_rows(opts, path_parts, files):
+            progress.add(1 if len(row) == 2 else row[1], row[-1])
+            yield row
+
+    # Only send the options the scanner needs to each worker
+    temp = {x: y for x, y in opts.items() if x.startswith("lfs_")}
+    temp['per_object'] = opts['per_object']
+
+    # The shards that haven't been sent out yet
+    waiting = dict(shards)
+    with Pool(opts['lfs_processes']) as pool:
+        jobs = [(temp, path, path_parts, target_dev, is_darwin) for path, path_parts in shards]
+        for path, rows in pool.imap_unordered(scan_shard, jobs):
+            for row in rows:
+                progress.add(1 if len(row) == 2 else row[1], row[-1])
+                yield row
+            del waiting[path]
+            if checkpoint is not None:
+                checkpoint(lambda: {'todo': list(waiting.items())})
+
+    progress.stop()
+
+def walk_folder_incremental(opts):
+    # Scan the tree, but reuse the totals from the last scan for any directory
+    # that hasn't changed since then.  A directory's mtime changes when an entry
+    # is added, removed, or renamed in it, so if it and the inode are the same,
+    # the list of files and sub-directories are the same.
+    db, known_id = opts['cache_db'], opts['cache_known_id']
+    db.execute("CREATE TABLE IF NOT EXISTS dir_state(id INT NOT NULL, path TEXT NOT NULL, gen INT NOT NULL, ino INT NOT NULL, mtime INT, count INT NOT NULL, size INT NOT NULL, dirs TEXT NOT NULL);")
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS dir_state_path_idx ON dir_state(id, path);")
+    db.commit()
+    # Each scan stamps every directory it sees, anything left with an older
+    # stamp at the end no longer exists
+    gen = 1 + (db.execute("SELECT MAX(gen) FROM dir_state WHERE id = ?;", (known_id,)).fetchone()[0] or 0)
+    # The new state is written along with the rows, through the cache's writer,
+    # reading the old state here doesn't need to wait on it
+    execute = opts['cache_execute']
+    state_sql = f"INSERT OR REPLACE INTO dir_state(id, path, gen, ino, mtime, count, size, dirs) VALUES ({known_id}, ?, {gen}, ?, ?, ?, ?, ?);"
+
+    # The last scan's total is a good guess for how much is left to do
+    stats = {"dirs": 0, "reused": 0}
+    progress = Progress(detail=lambda: f"reused {stats['reused']} of {stats['dirs']} directories")
+    progress.expected = db.execute("SELECT SUM(count) FROM dir_state WHERE id = ?;", (known_id,)).fetchone()[0]
+    progress.start()
+
+    base, target_dev, is_darwin = get_scan_settings(opts)
+    # Directories changed very recently might still be changing, and the
+    # mtime might not have enough resolution to notice, so don't trust them
+    # next time around
+    trust_before = (time.time() - 2) * 1000000000
+    todo = deque([(base, [])])
+
     while len(todo) > 0:
         path, path_parts = todo.pop()
-        # Use scandir instead of other options to force FindFirstFile on Windows
-        # for a considerable speedup.  These functions aren't recursive on their
-        # own, so track directories in a deque and recurse manually.
-        # Order here isn't important, it'll be sorted elsewhere, so whatever scandir
-        # returns in is fine.
         try:
-            for cur in os.scandir(path):
-                try:
-                    if stat.S_ISDIR(cur.stat().st_mode):
-                        use_directory = True
-                        if use_directory and not opts.get("lfs_follow_links", False):
-                            # We shouldn't follow into links and junctions, so see if this is junction
-                            if is_link(cur.path):
-                                # It's a link, so don't use it
-                                use_directory = False
-                        if use_directory and not opts.get("lfs_follow_mounts", False):
-                            # We shouldn't follow into mount points, so see if this directory is the same device
-                            if cur.stat().st_dev != target_dev:
-                                # It's on a different device, ignore it
-                                use_directory = False
-                        if use_directory and is_darwin and not opts.get("lfs_follow_mounts", False):
-                            # This directory is the root of the firmlinks on Darwin, ignore this
-                            if cur.path.startswith("/System/Volumes"):
-                                use_directory = False
-                        if use_directory:
-                            # It's a directory, add it to our list ot do
-                            todo.append((cur.path, path_parts + [cur.name]))
-                    else:
-                        # Pull out the size before doing anything with the data
-                        # to give the exception a chance to fire
-                        use_file = True
-                        if use_file and not opts.get("lfs_follow_mounts", False):
-                            # Check to see if a file is on a different device as well
-                            if cur.stat().st_dev != target_dev:
-                                # It's on a different devie, go ahead and ignore it
-                                use_file = False
-                        if use_file:
-                            size = cur.stat().st_size
-                            filename = cur.name
-                            # It's a file, add to our count and send it out
-                            total_objects += 1
-                            total_size += size
-                            msg(f"Scanning, gathered {total_objects} totaling {size_to_string(total_size)}...")
-                            yield path_parts + [filename], size
-                except (FileNotFoundError, OSError, PermissionError):
-                    # Ignore any files we don't see (mostly dangling links)
-                    # Also ignore any permission errors
-                    pass
+            info = os.stat(path)
         except (FileNotFoundError, OSError, PermissionError):
-            # And ignore any errors on the scandir itself, do this
-            # in to seperate try/except blocks so any errors on a single
-            # file don't break an entire folder
-            pass
-    msg(f"Done, saw {total_objects} totaling {size_to_string(total_size)}", newline=True)
-# ----- SCANNER_END -----------------------------------------------------------
+            continue
+        if target_dev is not None and info.st_dev != target_dev:
+            # Something has been mounted here since the last scan
+            continue
+
+        key = json.dumps(path_parts)
+        found = None
+        for row in db.execute("SELECT ino, mtime, count, size, dirs FROM dir_state WHERE id = ? AND path = ?;", (known_id, key)):
+            found = row
+
+        if found is not None and found[0] == info.st_ino and found[1] == info.st_mtime_ns:
+            # Nothing has changed, reuse the old totals and directory list
+            _, mtime, count, size, dirs = found
+            dirs = json.loads(dirs)
+            stats['reused'] += 1
+        else:
+            files, subdirs = scan_dir(opts, path, path_parts, target_dev, is_darwin)
+            mtime = info.st_mtime_ns if info.st_mtime_ns < trust_before else None
+            count, size = len(files), sum(size for _, size in files)
+            dirs = [x[1][-1] for x in subdirs]
+        execute(state_sql, (key, info.st_ino, mtime, count, size, json.dumps(dirs)))
+
+        stats['dirs'] += 1
+        todo.extend((os.path.join(path, x), path_parts + [x]) for x in dirs)
+        if count > 0:
+            progress.add(count, size)
+            # Send out the totals for this directory
+            yield path_parts, count, size
+
+    execute("DELETE FROM dir_state WHERE id = ? AND gen < ?;", (known_id, gen))
+    progress.stop()
+
+def get_cache_subset(flags, cached):
+    # A cached scan of a directory this one is inside of, with the same options,
+    # has already seen everything under this directory, as long as that scan
+    # would have gone into it
+    if not flags_match_except(flags, cached, 'lfs_base'):
+        return None
+    base = os.path.abspath(os.path.expanduser(flags['lfs_base']))
+    cached_base = os.path.abspath(os.path.expanduser(cached['lfs_base']))
+    try:
+        rel = os.path.relpath(base, cached_base)
+    except ValueError:
+        # On Windows, the paths are on different drives
+        return None
+    if rel == os.curdir:
+        return [], None, True
+    parts = split(rel)
+    if parts[0] == os.pardir:
+        return None
+    try:
+        if not flags.get('lfs_follow_mounts', False) and os.stat(base).st_dev != os.stat(cached_base).st_dev:
+            # The cached scan didn't cross into other mounts
+            return None
+        if not flags.get('lfs_follow_links', False):
+            # Nor did it go into any links along the way
+            for i in range(1, len(parts) + 1):
+                if is_link(os.path.join(cached_base, *parts[:i])):
+                    return None
+    except (FileNotFoundError, OSError, PermissionError):
+        return None
+    return parts, None, True
+
+def scan_folder(opts):
+    if opts.get('lfs_incremental', False):
+        return walk_folder_incremental(opts)
+    elif opts.get('lfs_processes', 1) > 1:
+        return walk_folder_processes(opts)
+    elif opts.get('lfs_threads', 1) > 1:
+        return walk_folder_threaded(opts)
+    else:
+        return walk_folder(opts)
 
 def split(path):
     # Simple split/join methods meant to be symmentrical and somewhat OS aware
@@ -1,39 +1,133 @@
 #!/usr/bin/env python3
 
-from utils import BatchingSql
-import sys, sqlite3, random, re, string
-
-if len(sys.argv) != 3:
-    print("Specify source cache file, and output file")
-    print("Will obfuscate all filenames and write out file")
-    exit(1)
-
-db_src = sqlite3.connect(sys.argv[1])
-db_dest = sqlite3.connect(sys.argv[2])
-
-# Create and empty the dest database
-db_dest.execute("CREATE TABLE IF NOT EXISTS files(key TEXT NOT NULL, size NOT NULL);")
-db_dest.commit()
-db_dest.execute("DELETE FROM files;")
-db_dest.commit()
-
-# Seed random so reruns produce the same obfuscated results
-random.seed(42)
-
-# All of the current random strings produced for each word
-hidden = {}
-
-sql = BatchingSql(db_dest, "INSERT INTO files(key, size) VALUES (?, ?);")
-for key, value in db_src.execute("SELECT key, size FROM files;"):
-    key = re.split("([/\\\\])", key)
-    for x in key:
-        if x not in {"/", "\\"}:
-            if x not in hidden:
-                hidden[x] = "".join(random.choice(string.ascii_lowercase) for _ in range(random.randint(5, 10)))
-    sql.execute("".join(hidden.get(x, x) for x in key), value)
-sql.finish()
-
-db_dest.close()
-db_src.close()
-
-print("All done!")
\ No newline at end of file
+from collections import deque
+from multiprocessing import Pool
+from scan_cache import decode_name, open_cache
+from utils import hash_name
+import json
+import os
+import sys
+import tempfile
+
+# Copy a cache file, replacing every name in it with a fake name, so the file
+# can be shared without showing what's in it.  Names are replaced with a keyed
+# hash, so the same name is always replaced the same way without needing to
+# remember every name seen, which lets the work be split between processes,
+# and lets the rows stream through without using more memory as the file grows.
+#
+# Only finished scans are copied.  The summed up trees and the details stored
+# for incremental scans also have names in them, so they're left out, the trees
+# will be created again the first time the copy is used.
+
+# Rows are read and handed to the workers in batches of this many rows
+BATCH_ROWS = 10000
+
+def hide_rows(job):
+    # Runs on a worker process, hide the name column of each row in a batch
+    key, column, rows = job
+    ret = []
+    for row in rows:
+        if row[column] is not None:
+            row = row[:column] + (hash_name(key, decode_name(row[column])),) + row[column + 1:]
+        ret.append(row)
+    return ret
+
+def hide_flags(key, flags):
+    # The flags have things like the bucket name or path in them, so hide every
+    # string other than the scanner switch
+    flags = json.loads(flags)
+    for name, value in flags.items():
+        if isinstance(value, str) and name != "target_switch":
+            flags[name] = hash_name(key, value)
+    return json.dumps(flags, sort_keys=True)
+
+def copy_table(pool, processes, key, db_src, db_dest, select, insert, column):
+    # Stream one table from the source to the dest, only a few batches are
+    # ever waiting on the workers at a time
+    cur = db_src.execute(select)
+    pending = deque()
+    while True:
+        rows = cur.fetchmany(BATCH_ROWS)
+        if len(rows) > 0:
+            pending.append(pool.apply_async(hide_rows, ((key, column, rows),)))
+        if len(pending) > 0 and (len(pending) >= processes * 4 or len(rows) == 0):
+            db_dest.executemany(insert, pending.popleft().get())
+            db_dest.commit()
+        if len(rows) == 0 and len(pending) == 0:
+            break
+
+def main():
+    args = sys.argv[1:]
+    key = None
+    processes = os.cpu_count()
+    while len(args) > 2:
+        if len(args) >= 4 and args[0] == "--key":
+            key = args[1]
+            args = args[2:]
+        elif len(args) >= 4 and args[0] == "--processes" and args[1].isdigit() and int(args[1]) > 0:
+            processes = int(args[1])
+            args = args[2:]
+        else:
+            break
+
+    if len(args) != 2:
+        print("Usage: obfuscate_cache.py [--key <value>] [--processes <value>] <source> <dest>")
+        print("Will obfuscate all names in the source cache file and write out the dest file")
+        print("Use the same key to get the same fake names each run, otherwise a random key is used")
+        exit(1)
+
+    src, dest = args
+    if key is None:
+        key = os.urandom(32)
+    else:
+        key = key.encode("utf-8")
+
+    if not os.path.isfile(src):
+        print(f"ERROR: Unable to find the source cache file {src}")
+        exit(1)
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        print("ERROR: The source and dest are the same file")
+        exit(1)
+
+    # Write to a new file next to dest, and only replace dest once the copy is
+    # done, so a failed copy doesn't leave anything behind
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest)), prefix=os.path.basename(dest) + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        copy_cache(key, processes, src, temp)
+        # The old dest's journal files would be applied to the new file
+        for suffix in ["-wal", "-shm"]:
+            if os.path.isfile(dest + suffix):
+                os.unlink(dest + suffix)
+        os.replace(temp, dest)
+    finally:
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.isfile(temp + suffix):
+                os.unlink(temp + suffix)
+
+    print("All done!")
+
+def copy_cache(key, processes, src, dest):
+    db_src = open_cache(src)
+    db_dest = open_cache(dest)
+
+    with Pool(processes) as pool:
+        for known_id, flags, meta in db_src.execute("SELECT id, flags, meta FROM options WHERE valid = 1;").fetchall():
+            db_dest.execute("INSERT INTO options(id, flags, valid, meta) VALUES (?, ?, 1, ?);", (known_id, hide_flags(key, flags), meta))
+            # The root directory has an empty name, leave that as is
+            copy_table(pool, processes, key, db_src, db_dest,
+                f"SELECT id, dir, parent, name, total_count, total_size FROM dirs WHERE id = {known_id} AND dir > 0;",
+                "INSERT INTO dirs(id, dir, parent, name, total_count, total_size) VALUES (?, ?, ?, ?, ?, ?);", 3)
+            for row in db_src.execute("SELECT id, dir, parent, name, total_count, total_size FROM dirs WHERE id = ? AND dir = 0;", (known_id,)):
+                db_dest.execute("INSERT INTO dirs(id, dir, parent, name, total_count, total_size) VALUES (?, ?, ?, ?, ?, ?);", row)
+            copy_table(pool, processes, key, db_src, db_dest,
+                f"SELECT id, dir, name, size, count, class FROM files WHERE id = {known_id} ORDER BY rowid;",
+                "INSERT INTO files(id, dir, name, size, count, class) VALUES (?, ?, ?, ?, ?, ?);", 2)
+            db_dest.commit()
+            print(f"Copied cached scan #{known_id}")
+
+    db_dest.close()
+    db_src.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,24 @@
 #!/usr/bin/env python3
 
 from collections import defaultdict
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from utils import chunks, count_to_string, hide_value, register_abstraction, size_to_string, TempMessage
-from multiprocessing import Pool
+from utils import AdaptiveLimit, chunks, count_to_string, flags_match_except, hide_value, JobQueue, Progress, put_unless_stopped, register_abstraction, size_to_string
 from urllib.parse import unquote, unquote_plus
-from aws_pager import aws_pager
+from aws_pager import aws_pager, aws_pager_pages, aws_pager_pages_prefetch
+import contextlib
 import csv
 import gzip
+import hashlib
 import io
 import json
 import os
+import queue
 import re
+import shutil
 import sys
+import tempfile
+import threading
 if sys.version_info >= (3, 11): from datetime import UTC
 else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
 try:
@@ -25,17 +31,52 @@ try:
     IMPORTS_OK = True
 except:
     IMPORTS_OK = False
+# The S3 Inventory formats that can be read, Parquet and ORC need pyarrow, so
+# only allow them if it can be imported
+INVENTORY_FORMATS = {"CSV"}
+try:
+    import pyarrow.compute
+    import pyarrow.parquet
+    INVENTORY_FORMATS.add("Parquet")
+    import pyarrow.orc
+    INVENTORY_FORMATS.add("ORC")
+except:
+    pass
 register_abstraction(__name__)
 
 MAIN_SWITCH = "--s3"
 FLAG_PREFIX = "s3_"
 DESCRIPTION = "Scan AWS S3 for object sizes"
+# Flags that change how the scan is run, but not what it finds, these
+# aren't used to tell cached scans apart
+RUNTIME_FLAGS = {"s3_threads", "s3_inventory_cache", "s3_inventory_cache_size"}
+# Flags that only change how the results are shown, each object's storage class
+# is stored with it, so these are worked out from the same scan
+RENDER_FLAGS = {"s3_cost", "s3_storage_class"}
+# How many S3 Inventory data files to read at once, unless --threads is used
+INVENTORY_THREADS = 4
+# Objects from S3 Inventory data files are passed along in batches of this many
+INVENTORY_BATCH_ROWS = 10000
+# The default size limit of --inventory_cache, in GiB
+INVENTORY_CACHE_SIZE = 10
+# How many requests to run at once for --all_buckets, unless --threads is used
+ALL_BUCKETS_THREADS = 16
+# The most queries CloudWatch allows in one get_metric_data call
+METRIC_QUERIES = 500
+# Error codes AWS uses to ask for fewer requests
+THROTTLE_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException"}
+# How many times to try a request that's throttled when listing with --threads
+THROTTLE_ATTEMPTS = 10
 
 def handle_args(opts, args):
     if not IMPORTS_OK:
         opts['show_help'] = True
         print("ERROR: Unable to import boto3, unable to call S3 APIs!")
 
+    # Scans now keep the storage class of each object, older cached scans
+    # didn't, so this keeps them from being used
+    opts['s3_by_class'] = True
+
     while not opts['show_help']:
         if len(args) >= 2 and args[0] == "--profile":
             opts['s3_profile'] = args[1]
@@ -52,15 +93,35 @@ def handle_args(opts, args):
         elif len(args) >= 1 and args[0] == "--cost":
             opts['s3_cost'] = True
             args = args[1:]
+        elif len(args) >= 2 and args[0] == "--storage_class":
+            opts['s3_storage_class'] = args[1]
+            args = args[2:]
         elif len(args) >= 1 and args[0] == "--inventory":
             opts['s3_inventory'] = True
             args = args[1:]
+        elif len(args) >= 2 and args[0] == "--inventory_cache":
+            opts['s3_inventory_cache'] = args[1]
+            args = args[2:]
+        elif len(args) >= 2 and args[0] == "--inventory_cache_size":
+            try:
+                opts['s3_inventory_cache_size'] = float(args[1])
+                args = args[2:]
+            except ValueError:
+                opts['show_help'] = True
+                print("ERROR: --inventory_cache_size needs to be a number")
         elif len(args) >= 1 and args[0] == "--no-sign-request":
             opts['no-sign-request'] = True
             args = args[1:]
         elif len(args) >= 2 and args[0] == "--endpoint":
             opts['s3_endpoint'] = args[1]
             args = args[2:]
+        elif len(args) >= 2 and args[0] == "--threads":
+            if not args[1].isdigit() or int(args[1]) < 1:
+                opts['show_help'] = True
+                print("ERROR: --threads needs to be a number of at least 1")
+            else:
+                opts['s3_threads'] = int(args[1])
+                args = args[2:]
         else:
             break
     
@@ -92,15 +153,24 @@ def handle_args(opts, args):
 
 def get_help():
     return f"""
-        --profile <value>  = AWS CLI profile name to use (optional)
-        --bucket <value>   = S3 Bucket to scan
-        --endpoint <value> = Custom endpoint URL to use for S3
-        --inventory        = Use S3 Inventory report to get list of objects in bucket
-        --prefix <value>   = Prefix to start scanning from (optional)
-        --all_buckets      = Show size of all buckets (only if --bucket/--prefix isn't used)
-                             (--profile may be a comma delimited list of profiles for this mode)
-        --cost             = Count cost instead of size for objects
-        --no-sign-request  = Don't sign requests
+        --profile <value>              = AWS CLI profile name to use (optional)
+        --bucket <value>               = S3 Bucket to scan
+        --endpoint <value>             = Custom endpoint URL to use for S3
+        --inventory                    = Use S3 Inventory report to get list of objects in bucket
+                                         (Parquet and ORC reports need pyarrow, otherwise only CSV)
+        --inventory_cache <value>      = Folder to keep downloaded S3 Inventory files in, so
+                                         they don't need to be downloaded again (optional)
+        --inventory_cache_size <value> = Largest size of that folder in GiB, the files used
+                                         least recently are removed first (default: {INVENTORY_CACHE_SIZE})
+        --prefix <value>               = Prefix to start scanning from (optional)
+        --all_buckets                  = Show size of all buckets (only if --bucket/--prefix isn't used)
+                                         (--profile may be a comma delimited list of profiles for this mode)
+        --cost                         = Count cost instead of size for objects
+        --storage_class <value>        = Only show objects in these storage classes, comma delimited
+                                         (for --all_buckets, these are CloudWatch storage types)
+        --no-sign-request              = Don't sign requests
+        --threads <value>              = Most requests to S3 to run at once, fewer are used
+                                         while S3 is asking for requests to slow down (optional)
     """ + ("" if IMPORTS_OK else """
         WARNING: boto3 import failed, module will not work correctly!
     """)
@@ -112,7 +182,7 @@ def get_profiles(opts):
         temp['s3_profile'] = cur
         yield cur
 
-def get_s3(opts, profile_name=None):
+def get_s3(opts, profile_name=None, threads=None, limit=None):
     args = {}
     if 's3_endpoint' in opts:
         args['endpoint_url'] = opts['s3_endpoint']
@@ -122,19 +192,43 @@ def get_s3(opts, profile_name=None):
     else:
         profile = profile_name
 
+    config = {}
     if "no-sign-request" in opts:
-        args['config'] = Config(signature_version=UNSIGNED)
+        config['signature_version'] = UNSIGNED
+    if threads is None:
+        threads = opts.get('s3_threads', 1)
+    if threads > 10:
+        # Make sure every thread can have a connection open at once
+        config['max_pool_connections'] = threads
+    if limit is not None:
+        # Throttled requests are tried again, while the limit backs off
+        config['retries'] = {'mode': 'standard', 'max_attempts': THROTTLE_ATTEMPTS}
+    if len(config) > 0:
+        args['config'] = Config(**config)
 
     if len(profile):
-        return boto3.Session(profile_name=profile).client('s3', **args)
+        s3 = boto3.Session(profile_name=profile).client('s3', **args)
     else:
-        return boto3.client('s3', **args)
+        s3 = boto3.client('s3', **args)
+
+    if limit is not None:
+        # botocore retries throttled requests on its own, so watch for them
+        # as they happen, rather than only when it gives up
+        def on_retry(response, **kwargs):
+            if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+                limit.throttled()
+        s3.meta.events.register('needs-retry.s3', on_retry)
+    return s3
+
+def get_cw(profile, region, threads=1):
+    args = {'region_name': region}
+    if threads > 10:
+        args['config'] = Config(max_pool_connections=threads)
 
-def get_cw(profile, region):
     if len(profile):
-        return boto3.Session(profile_name=profile).client('cloudwatch', region_name=region)
+        return boto3.Session(profile_name=profile).client('cloudwatch', **args)
     else:
-        return boto3.client('cloudwatch', region_name=region)
+        return boto3.client('cloudwatch', **args)
 
 def get_bucket_location(s3, bucket):
     location = s3.get_bucket_location(Bucket=bucket)['LocationConstraint']
@@ -142,12 +236,31 @@ def get_bucket_location(s3, bucket):
     location = {None: 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
     return location
 
-def get_bucket_location_worker(job):
-    # Helper to handle lookup on a different process
-    opts, profile, bucket = job
-    s3 = get_s3(opts, profile)
-    location = get_bucket_location(s3, bucket)
-    return bucket, location
+def find_bucket_regions(progress, pool, opts, threads):
+    # Find the region of every bucket for each profile, returns a dictionary of
+    # (profile, region) to the buckets in it.  Clients are created here, since
+    # creating them isn't thread safe, but each one is shared by all the threads
+    clients = {profile: get_s3(opts, profile, threads) for profile in get_profiles(opts)}
+    listed = {profile: pool.submit(s3.list_buckets) for profile, s3 in clients.items()}
+    jobs = {}
+    for profile, future in listed.items():
+        for cur in future.result()['Buckets']:
+            jobs[pool.submit(get_bucket_location, clients[profile], cur['Name'])] = profile, cur['Name']
+
+    ret = defaultdict(list)
+    for seen_buckets, future in enumerate(as_completed(jobs)):
+        profile, bucket = jobs[future]
+        ret[profile, future.result()].append(bucket)
+        progress.message(f"Scanning, finding buckets, gathered data for {seen_buckets + 1} of {len(jobs)} buckets...", temp=True)
+    return ret
+
+def get_metric_data(cw, queries, start_date):
+    # Helper to run one batch of CloudWatch queries on a thread
+    return list(aws_pager(cw, 'get_metric_data', 'MetricDataResults',
+        MetricDataQueries=queries,
+        StartTime=start_date,
+        EndTime=start_date + timedelta(days=1),
+    ))
 
 def load_s3_cost_classes():
     # Load the pricing data, using this module's location as an anchor point
@@ -161,8 +274,219 @@ def load_pricing_data():
     with open(fn) as f:
         return json.load(f)
 
-def get_bucket_inventory(msg, s3, bucket, required_fields=set(), prefix=""):
-    # Load a S3 inventory report, including parsing CSV files
+def get_class_weights(opts):
+    # Returns a function giving how much a byte in each storage class counts
+    # for, or None to leave that class out.  Rows from a bucket have the S3
+    # storage class, rows for all buckets have the CloudWatch storage type and
+    # the region of the bucket, like "StandardStorage@us-east-1".  The count
+    # of objects in a bucket has every storage type the bucket uses, like
+    # "StandardStorage,GlacierStorage@us-east-1", and no size, so it's only
+    # left out if none of them are wanted
+    wanted = None
+    if 's3_storage_class' in opts:
+        wanted = set(opts['s3_storage_class'].split(","))
+    pricing, location = None, None
+
+    def get_weight(row_class):
+        nonlocal pricing, location
+        storage, _, region = row_class.partition("@")
+        if len(storage) == 0 and (wanted is not None or opts.get('s3_cost', False)):
+            # Scanned from a S3 Inventory report without the StorageClass field
+            raise Exception("This scan doesn't have the storage class of each object, it used a S3 Inventory report without the StorageClass field, scan again with a new --cache file to use --cost or --storage_class")
+        if wanted is not None and len(wanted & set(storage.split(","))) == 0:
+            return None
+        if not opts.get('s3_cost', False) or "," in storage:
+            return 1
+        if pricing is None:
+            pricing = load_pricing_data()
+        if len(region) == 0:
+            # A bucket's own storage class, the costs are for the region it's in
+            source = 's3'
+            if location is None:
+                # The scan notes the region, unless it couldn't look it up
+                location = opts['scan_meta'].get('s3_region')
+            if location is None:
+                location = get_bucket_location(get_s3(opts), opts['s3_bucket'])
+            region = location
+        else:
+            source = 'cw'
+        if region not in pricing:
+            raise Exception(f"Unknown costs for region {region}!")
+        for cur in load_s3_cost_classes():
+            if storage == cur[source]:
+                # The pricing is per GiB
+                return float(pricing[region][cur['desc']]) / 1073741824
+        raise Exception(f"Unknown costs for storage class {storage}!")
+
+    return get_weight
+
+class InventoryCache:
+    # A folder of files downloaded from S3, used to keep S3 Inventory reports
+    # around between runs.  Each file is stored by its bucket, key and ETag, so
+    # a changed object is downloaded again.  Once the folder is over its size
+    # limit, the files used the longest ago are removed
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def open(self, s3, bucket, key):
+        # Open a file, downloading it if it's not already in the cache
+        etag = s3.head_object(Bucket=bucket, Key=key)['ETag']
+        fn = os.path.join(self.path, hashlib.sha256(f"{bucket}/{key}/{etag}".encode("utf-8")).hexdigest() + ".cache")
+        try:
+            f = open(fn, "rb")
+            # The modified time is used to track when the file was last used
+            os.utime(fn)
+            return f
+        except FileNotFoundError:
+            pass
+
+        # Download to a temp file first, so a partial download is never used
+        fd, temp_fn = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(s3.get_object(Bucket=bucket, Key=key, IfMatch=etag)['Body'], f)
+            os.replace(temp_fn, fn)
+        except:
+            os.unlink(temp_fn)
+            raise
+        f = open(fn, "rb")
+        self.evict()
+        return f
+
+    def evict(self):
+        # Remove the least recently used files until the folder is small enough
+        with self.lock:
+            files = []
+            for cur in os.scandir(self.path):
+                if cur.name.endswith(".cache"):
+                    info = cur.stat()
+                    files.append((info.st_mtime, info.st_size, cur.path))
+            total = sum(size for _, size, _ in files)
+            for _, size, fn in sorted(files):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(fn)
+                    total -= size
+                except OSError:
+                    # Most likely still open on a system that doesn't allow
+                    # removing open files, it'll be removed next time
+                    pass
+
+def get_inventory_cache(opts):
+    if 's3_inventory_cache' not in opts:
+        return None
+    return InventoryCache(opts['s3_inventory_cache'], int(opts.get('s3_inventory_cache_size', INVENTORY_CACHE_SIZE) * 1073741824))
+
+def open_inventory_file(s3, bucket, key, cache, seekable=False):
+    # Open a file from an inventory report, from the local cache if one is used.
+    # Without a cache, the download is read as it arrives, unless the caller
+    # needs to seek around in the file
+    if cache is not None:
+        return cache.open(s3, bucket, key)
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    if not seekable:
+        return contextlib.closing(body)
+    f = tempfile.TemporaryFile()
+    shutil.copyfileobj(body, f)
+    f.seek(0)
+    return f
+
+def read_inventory_file(s3, inv_bucket, key, cache, columns, prefix, send):
+    # Runs on a worker thread, read one CSV file from an inventory report, and
+    # send along the objects under prefix in batches of (key, size, storage class)
+    key_col, size_col, class_col = columns
+    batch = []
+    with open_inventory_file(s3, inv_bucket, key, cache) as csv_gz, gzip.GzipFile(fileobj=csv_gz) as gzf:
+        for row in csv.reader(io.TextIOWrapper(gzf)):
+            # Ignore Delete Markers and other objects that don't have a size
+            if len(row[size_col]) > 0:
+                key = unquote(row[key_col])
+                if key.startswith(prefix):
+                    batch.append((key[len(prefix):], int(row[size_col]), "" if class_col is None else row[class_col]))
+                    if len(batch) >= INVENTORY_BATCH_ROWS:
+                        if not send(batch):
+                            return
+                        batch = []
+    if len(batch) > 0:
+        send(batch)
+
+def read_columnar_inventory_file(s3, inv_bucket, key, cache, file_format, prefix, send):
+    # Runs on a worker thread, read one Parquet or ORC file from an inventory
+    # report.  Only the columns that are needed are read, and each chunk is
+    # filtered all at once.  Unlike CSV files, keys aren't URL encoded
+    with open_inventory_file(s3, inv_bucket, key, cache, seekable=True) as f:
+        if file_format == "Parquet":
+            pf = pyarrow.parquet.ParquetFile(f)
+            columns = [x for x in ("key", "size", "storage_class") if x in pf.schema_arrow.names]
+            data = pf.iter_batches(batch_size=INVENTORY_BATCH_ROWS, columns=columns)
+        else:
+            of = pyarrow.orc.ORCFile(f)
+            columns = [x for x in ("key", "size", "storage_class") if x in of.schema.names]
+            data = (of.read_stripe(i, columns=columns) for i in range(of.nstripes))
+
+        for chunk in data:
+            # ORC stripes can be large, so break them up
+            for start in range(0, chunk.num_rows, INVENTORY_BATCH_ROWS):
+                part = chunk.slice(start, INVENTORY_BATCH_ROWS)
+                # Ignore Delete Markers and other objects that don't have a size
+                mask = pyarrow.compute.is_valid(part.column(1))
+                if len(prefix) > 0:
+                    mask = pyarrow.compute.and_(mask, pyarrow.compute.starts_with(part.column(0), prefix))
+                part = part.filter(mask)
+                if part.num_rows == 0:
+                    continue
+                keys = [x[len(prefix):] for x in part.column(0).to_pylist()]
+                classes = part.column(2).to_pylist() if len(columns) > 2 else [""] * part.num_rows
+                if not send(list(zip(keys, part.column(1).to_pylist(), classes))):
+                    return
+
+def read_inventory_files(s3, inv_bucket, keys, cache, file_format, columns, prefix, threads):
+    # Read the data files of an inventory report, several at once.  Batches are
+    # passed back through a queue that only holds a few of them, so no matter
+    # how far behind the caller is, only that much is kept in memory
+    batches = queue.Queue(threads * 4)
+    stop = threading.Event()
+
+    def send(item):
+        return put_unless_stopped(batches, item, stop)
+
+    def worker(key):
+        try:
+            if file_format == "CSV":
+                read_inventory_file(s3, inv_bucket, key, cache, columns, prefix, send)
+            else:
+                read_columnar_inventory_file(s3, inv_bucket, key, cache, file_format, prefix, send)
+            # Let the caller know this file is done
+            send(None)
+        except Exception as ex:
+            send(ex)
+
+    pool = ThreadPoolExecutor(threads)
+    try:
+        for key in keys:
+            pool.submit(worker, key)
+        remaining = len(keys)
+        while remaining > 0:
+            cur = batches.get()
+            if cur is None:
+                remaining -= 1
+            elif isinstance(cur, Exception):
+                raise cur
+            else:
+                yield cur
+    finally:
+        # If the caller stopped early, or something failed, don't bother with
+        # the rest of the files
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def get_bucket_inventory(progress, s3, bucket, required_fields=set(), prefix="", threads=INVENTORY_THREADS, cache=None):
+    # Load a S3 inventory report, including parsing the data files, returns batches
+    # of (key, size, storage class) for each object, with keys relative to prefix
     possible_configs = []
     config = None
 
@@ -172,8 +496,8 @@ def get_bucket_inventory(msg, s3, bucket, required_fields=set(), prefix=""):
         if not cur.get("IsEnabled", False):
             # Needs to be an active inventory report
             valid = False
-        elif cur.get('Destination', {}).get('S3BucketDestination', {}).get('Format', '') != "CSV":
-            # Require CSV format
+        elif cur.get('Destination', {}).get('S3BucketDestination', {}).get('Format', '') not in INVENTORY_FORMATS:
+            # Require a format that can be read
             valid = False
         elif len(set(cur['OptionalFields']) & required_fields) != len(required_fields):
             # Require different fields, at least Size, but might also need StorageClass for "cost"
@@ -194,13 +518,17 @@ def get_bucket_inventory(msg, s3, bucket, required_fields=set(), prefix=""):
         #   Longer prefix (less data to download and parse)
         #   Daily over anything else (more up to date)
         #   Only current object versions (less data to download)
+        #   Having the storage class, so the same scan can show costs later
         #   Less fields (less data to download)
+        #   Parquet or ORC over CSV (less data to download, faster to parse)
         # Other differences are ignored
         possible_configs.sort(key=lambda x: (
             -len(x.get("Filter", {}).get("Prefix", "")),
             1 if x.get("Schedule", {}).get("Frequency", "") == "Daily" else 2,
             1 if x.get("IncludedObjectVersions", "") == "Current" else 2,
+            1 if "StorageClass" in x.get("OptionalFields", []) else 2,
             -len(x.get("OptionalFields", [])),
+            2 if x['Destination']['S3BucketDestination']['Format'] == "CSV" else 1,
         ))
         # And pull out the best option
         config = possible_configs[0]
@@ -209,7 +537,7 @@ def get_bucket_inventory(msg, s3, bucket, required_fields=set(), prefix=""):
         msg = f"Unable to find S3 Inventory report for '{bucket}'"
         if len(prefix) > 0:
             msg += f", that includes at least the prefix '{prefix}'"
-        msg += ", in the CSV format"
+        msg += ", in the " + " or ".join(sorted(INVENTORY_FORMATS)) + " format"
         if len(required_fields) > 0:
             msg += ", with the optional fields of " + ', '.join(f"'{x}'" for x in required_fields)
         msg += ", that includes all object versions"
@@ -225,45 +553,44 @@ def get_bucket_inventory(msg, s3, bucket, required_fields=set(), prefix=""):
 
     # List all of the reports
     reports = []
-    for _, prefix in aws_pager(s3, 'list_objects_v2', 'CommonPrefixes', Bucket=inv_bucket, Prefix=inv_prefix, Delimiter="/"):
+    for _, cur in aws_pager(s3, 'list_objects_v2', 'CommonPrefixes', Bucket=inv_bucket, Prefix=inv_prefix, Delimiter="/"):
         # Look for report "folders", ignoring the hive and data folders
-        if re.search("[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}-[0-9]{2}Z/$", prefix['Prefix']) is not None:
-            reports.append(prefix['Prefix'] + "manifest.json")
+        if re.search("[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}-[0-9]{2}Z/$", cur['Prefix']) is not None:
+            reports.append(cur['Prefix'] + "manifest.json")
 
     found = False
     # Find the latest report we can get
     for report in reports[::-1]:
         try:
-            resp = s3.get_object(Bucket=inv_bucket, Key=report)
+            manifest = open_inventory_file(s3, inv_bucket, report, cache)
             found = True
         except botocore.exceptions.ClientError as ex:
-            if ex.response['Error']['Code'] == 'NoSuchKey':
+            # Checking the ETag for the cache fails with a 404 instead
+            if ex.response['Error']['Code'] in ('NoSuchKey', '404'):
                 # It might fail if it's in the middle of an upload, so 
                 # ignore that edge case, and go back in time to an older report
                 continue
             else:
                 raise
         # Load the manifest file
-        resp = json.loads(resp['Body'].read())
+        with manifest as f:
+            resp = json.loads(f.read())
 
         updated = int(resp['creationTimestamp'])
         updated = datetime.fromtimestamp(updated/1000)
-        msg(f'Using S3 Inventory report "{config["Id"]}" generated {updated.strftime("%Y-%m-%d %H:%M:%S")}...', newline=True, force=True)
-
-        # Pull out the schema for these CSV files
-        schema = [x.strip() for x in resp['fileSchema'].split(",")]
-        for file in resp['files']:
-            # And read through each row in this file
-            csv_gz = s3.get_object(Bucket=inv_bucket, Key=file['key'])['Body']
-            with gzip.GzipFile(fileobj=csv_gz) as gzf:
-                sr = io.TextIOWrapper(gzf)
-                cr = csv.reader(sr)
-                for row in cr:
-                    # Merge the schema and each row
-                    row = {x: y for x, y in zip(schema, row)}
-                    # Ignore Delete Markers and other objects that don't have a size
-                    if len(row['Size']) > 0:
-                        yield row
+        progress.message(f'Using S3 Inventory report "{config["Id"]}" generated {updated.strftime("%Y-%m-%d %H:%M:%S")}...')
+
+        file_format = config['Destination']['S3BucketDestination']['Format']
+        if file_format == "CSV":
+            # Pull out the schema for these CSV files, only a few columns are
+            # used, so just find where they are
+            schema = [x.strip() for x in resp['fileSchema'].split(",")]
+            columns = (schema.index('Key'), schema.index('Size'), schema.index('StorageClass') if 'StorageClass' in schema else None)
+        else:
+            # Parquet and ORC files name their own columns
+            columns = None
+        for batch in read_inventory_files(s3, inv_bucket, [x['key'] for x in resp['files']], cache, file_format, columns, prefix, threads):
+            yield batch
 
         # We're done with this report, don't move on to the next one
         break
@@ -271,110 +598,189 @@ def get_bucket_inventory(msg, s3, bucket, required_fields=set(), prefix=""):
     if not found:
         raise Exception(f"Unable to find any inventory report data files for report '{config['Id']}', has it run?")
 
-def s3_list_objects(msg, opts, s3):
+def s3_list_objects(progress, opts, s3, limit=None):
     # Wrapper to call list_object_versions normally, or call into Inventory
-    # if that option is specified
+    # if that option is specified.  Either way, the objects are returned in
+    # batches of (key, size, storage class), with keys relative to the prefix
 
     prefix_len = len(opts.get('s3_prefix', ''))
 
     if opts.get('s3_inventory', False):
         # Using a S3 Inventory report
         required_fields = {"Size"}
-        if opts.get('s3_cost', False):
+        if opts.get('s3_cost', False) or 's3_storage_class' in opts:
             required_fields.add("StorageClass")
-        prefix = opts.get('s3_prefix', '')
-        for row in get_bucket_inventory(msg, s3, opts['s3_bucket'], required_fields=required_fields, prefix=prefix):
-            key = unquote(row['Key'])
-            if key.startswith(prefix):
-                yield {
-                    'Key': key[prefix_len:],
-                    'Size': int(row['Size']),
-                    'StorageClass': row.get('StorageClass', ''),
-                }
+        threads = opts.get('s3_threads', INVENTORY_THREADS)
+        cache = get_inventory_cache(opts)
+        for batch in get_bucket_inventory(progress, s3, opts['s3_bucket'], required_fields=required_fields, prefix=opts.get('s3_prefix', ''), threads=threads, cache=cache):
+            yield batch
+    elif opts.get('s3_threads', 1) > 1 or 's3_jobs' in (opts.get('cache_resume') or {}):
+        # Listing many parts of the bucket at once, this is also used to pick
+        # up a scan that was interrupted while doing so
+        for batch in s3_list_objects_threaded(opts, s3, limit):
+            yield batch
     else:
         # Normal mode, just call list_object_versions and pass the results along
         args = {"Bucket": opts['s3_bucket']}
         if 's3_prefix' in opts:
             args['Prefix'] = opts['s3_prefix']
-
-        for _, cur in aws_pager(s3, 'list_object_versions', 'Versions', **args):
-            yield {
-                'Key': cur['Key'][prefix_len:],
-                'Size': cur['Size'],
-                'StorageClass': cur['StorageClass'],
-            }
+        if opts.get('cache_resume') is not None:
+            # Pick up with the page an interrupted scan was about to request
+            args.update(opts['cache_resume']['s3_next'])
+        checkpoint = opts.get('cache_checkpoint')
+
+        for page, next_args in aws_pager_pages_prefetch(s3, 'list_object_versions', 'Versions', **args):
+            yield [(cur['Key'][prefix_len:], cur['Size'], cur['StorageClass']) for _, cur in page]
+            if checkpoint is not None and next_args is not None:
+                checkpoint(lambda: {'s3_next': next_args})
+
+def list_prefixes(s3, limit, bucket, prefix):
+    # Runs on a worker thread, get the first page of "folders" under a prefix
+    with limit.request():
+        page, _ = next(aws_pager_pages(s3, 'list_object_versions', 'CommonPrefixes', Bucket=bucket, Prefix=prefix, Delimiter="/"))
+    return [cur['Prefix'] for _, cur in page]
+
+def find_split_points(pool, s3, limit, bucket, prefix, wanted):
+    # Find keys to split a listing on.  The top of the bucket is listed with a
+    # delimiter, like walking directories, one level at a time until there are
+    # enough "folders" to split on.  Only the first page of each is looked at,
+    # the objects themselves are found when the ranges are listed
+    prefixes = [prefix]
+    points = []
+    while len(prefixes) > 0 and len(points) < wanted:
+        jobs = [pool.submit(list_prefixes, s3, limit, bucket, x) for x in prefixes]
+        prefixes = [x for job in jobs for x in job.result()]
+        points.extend(prefixes)
+    points.sort()
+    # Pick out evenly spaced points if there are more than needed
+    if len(points) > wanted:
+        points = [points[(i * len(points)) // wanted] for i in range(wanted)]
+    return points
+
+def list_range(s3, limit, bucket, prefix, job):
+    # Runs on a worker thread, get one page for a job.  Each job is a range of
+    # keys, as the last key in the range, or None to go to the end, and the
+    # arguments to pick up with the next page in that range
+    end, next_args = job
+    with limit.request():
+        page, next_args = next(aws_pager_pages(s3, 'list_object_versions', 'Versions', Bucket=bucket, Prefix=prefix, **next_args))
+    if end is not None and len(page) > 0 and page[-1][1]['Key'] > end:
+        # Ran past the end of the range, the next range picks up from here
+        page = [x for x in page if x[1]['Key'] <= end]
+        next_args = None
+    return page, next_args
+
+def s3_list_objects_threaded(opts, s3, limit=None):
+    # List the bucket with many requests at once.  The keys are split up into
+    # ranges, and each range is listed from its start.  Every page is its own
+    # job, and whichever thread is free picks up the next one, so a large range
+    # doesn't hold up the rest.  The limit decides how many of the threads can
+    # be waiting on S3 at once
+    threads = opts.get('s3_threads', 1)
+    if limit is None:
+        limit = AdaptiveLimit(threads)
+    bucket, prefix = opts['s3_bucket'], opts.get('s3_prefix', '')
+
+    # Only keep a couple of pages in flight for each thread, so finished pages
+    # don't pile up if they're handed out slower than they arrive
+    pool = ThreadPoolExecutor(threads)
+    jobs = JobQueue(pool, lambda job: list_range(s3, limit, bucket, prefix, job), threads * 2)
+    try:
+        resume = opts.get('cache_resume')
+        if resume is None:
+            # Each range starts after the key the one before it ended with, use
+            # plenty of ranges so there's still work to share out near the end
+            start = {}
+            for point in find_split_points(pool, s3, limit, bucket, prefix, threads * 8):
+                jobs.add((point, start))
+                start = {'KeyMarker': point}
+            jobs.add((None, start))
+        elif 's3_next' in resume:
+            # Picking up a scan that was listing the bucket one page at a time
+            jobs.add((None, resume['s3_next']))
+        else:
+            for end, next_args in resume['s3_jobs']:
+                jobs.add((end, next_args))
+
+        for (end, _), (page, next_args) in jobs.results(opts.get('cache_checkpoint'), 's3_jobs'):
+            if next_args is not None:
+                jobs.add((end, next_args))
+            yield [(cur['Key'][len(prefix):], cur['Size'], cur['StorageClass']) for _, cur in page]
+    finally:
+        # If the caller stopped early, don't bother listing what's left
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def get_cache_subset(flags, cached):
+    # A cached scan of the same bucket, with the same options but a prefix that
+    # this prefix starts with, has every object this scan would find.  Keys are
+    # stored without the prefix, so the rest of this prefix picks out the
+    # objects, the last part of it might only be the start of a name
+    if 's3_bucket' not in flags or not flags_match_except(flags, cached, 's3_prefix'):
+        return None
+    prefix, cached_prefix = flags.get('s3_prefix', ''), cached.get('s3_prefix', '')
+    if not prefix.startswith(cached_prefix):
+        return None
+    parts = prefix[len(cached_prefix):].split("/")
+    return parts[:-1], parts[-1], True
 
 def scan_folder(opts):
-    msg = TempMessage()
-    msg("Scanning...", force=True)
+    # The scan always finds sizes, along with the storage class of each object,
+    # costs are worked out from those with get_class_weights
+    progress = Progress()
 
-    total_objects, total_size = 0, 0
     if 's3_bucket' in opts:
         # Enumerate the objects in the target bucket
-        s3 = get_s3(opts)
-
-        if opts.get('s3_cost', False):
-            location = get_bucket_location(s3, opts['s3_bucket'])
-            temp = load_pricing_data()
-            if location not in temp:
-                raise Exception(f"Unknown costs for region {location}!")
-            # Lookup table to look up a S3 Storage Class to price per GiB
-            costs = {x['s3']: float(temp[location][x['desc']]) for x in load_s3_cost_classes()}
-        else:
-            location = None
-            costs = None
-
-        for i, cur in enumerate(s3_list_objects(msg, opts, s3)):
-            if location is None:
-                size = cur['Size']
-            else:
-                # We're in s3_cost mode, so use the cost as the size
-                # This is (<size> / 1 GiB) * <price per GiB>
-                size = (cur['Size'] / 1073741824) * costs[cur['StorageClass']]
-            total_objects += 1
-            total_size += size
-            yield cur['Key'].split("/"), size
-            if i % 1000 == 999:
-                msg(f"Scanning, gathered {total_objects} totaling {dump_size(opts, total_size)}...")
+        limit = None
+        if opts.get('s3_threads', 1) > 1 and 's3_inventory' not in opts:
+            # Listing with many requests at once, back off if S3 can't keep up
+            limit = AdaptiveLimit(opts['s3_threads'])
+            progress.detail = limit.describe
+        progress.start()
+        s3 = get_s3(opts, limit=limit)
+        if 's3_endpoint' not in opts:
+            # Note the bucket's region with the scan, so costs can be worked out
+            # from the cached results without asking for it again
+            try:
+                opts['scan_meta']['s3_region'] = get_bucket_location(s3, opts['s3_bucket'])
+            except botocore.exceptions.ClientError:
+                pass
+
+        for batch in s3_list_objects(progress, opts, s3, limit):
+            for key, size, storage_class in batch:
+                progress.add(1, size)
+                yield key.split("/"), None, size, storage_class
     else:
-        # List all the buckets, break out by region
-        buckets = defaultdict(lambda: defaultdict(list))
-        seen_buckets = 0
-        for profile in get_profiles(opts):
-            s3 = get_s3(opts, profile)
-            with Pool() as pool:
-                temp = {x: y for x, y in opts.items() if x.startswith("s3_")}
-                for bucket, location in pool.imap_unordered(get_bucket_location_worker, [(temp, profile, x['Name']) for x in s3.list_buckets()['Buckets']]):
-                    seen_buckets += 1
-                    msg(f"Scanning, finding buckets, gathered data for {seen_buckets} buckets...")
-                    buckets[profile][location].append(bucket)
-
-        # The range to query from CloudWatch, basically, get the latest metric for each bucket, 
-        # with some padding to handle the daily roll off of data
-        now = datetime.now(UTC).replace(tzinfo=None)
-        now = datetime(now.year, now.month, now.day)
-        start_date = now - timedelta(hours=36)
-        stats = defaultdict(lambda: defaultdict(dict))
-        bucket_to_region = {}
-
-        for profile in buckets:
-            for region in buckets[profile]:
+        # List all the buckets, break out by region.  Every request, for any
+        # profile or region, goes through the same pool of threads
+        progress.message("Scanning...", temp=True)
+        threads = opts.get('s3_threads', ALL_BUCKETS_THREADS)
+        pool = ThreadPoolExecutor(threads)
+        try:
+            regions = find_bucket_regions(progress, pool, opts, threads)
+
+            # The range to query from CloudWatch, basically, get the latest metric for each bucket, 
+            # with some padding to handle the daily roll off of data
+            now = datetime.now(UTC).replace(tzinfo=None)
+            now = datetime(now.year, now.month, now.day)
+            start_date = now - timedelta(hours=36)
+
+            # Pull out all of the possible cost classes
+            storages = [(x['cw'], 'BucketSizeBytes', True) for x in load_s3_cost_classes()]
+            # And ask for the number of objects in each bucket as well
+            storages.append(('AllStorageTypes', 'NumberOfObjects', False))
+
+            jobs = []
+            bucket_ids = {}
+            for (profile, region), region_buckets in sorted(regions.items()):
                 queries = []
-                bucket_ids = {}
-                cw = get_cw(profile, region)
-
-                # Pull out all of the possible cost classes
-                storages = [(x['cw'], 'BucketSizeBytes', True) for x in load_s3_cost_classes()]
-                # And ask for the number of objects in each bucket as well
-                storages.append(('AllStorageTypes', 'NumberOfObjects', False))
+                cw = get_cw(profile, region, threads)
 
                 # For each bucket in this region, add a request for each metric we want to track
-                for bucket in buckets[profile][region]:
-                    bucket_to_region[bucket] = region
-                    bucket_ids[bucket] = "%02d" % (len(bucket_ids),)
+                for bucket in sorted(region_buckets):
+                    bucket_ids[profile, bucket] = "%02d" % (len(bucket_ids),)
                     for storage, metric_name, _cost in storages:
                         queries.append({
-                                'Id': 'i' + bucket_ids[bucket] + storage,
+                                'Id': 'i' + bucket_ids[profile, bucket] + storage,
                                 'MetricStat': {
                                     'Metric': {
                                         'Namespace': 'AWS/S3',
@@ -389,75 +795,52 @@ def scan_folder(opts):
                                 }
                             })
 
-                # A place to store the metrics we'll gather up
-                final_metrics = {}
-                
-                # Call into cloudwatch as few times as possible
-                for chunk_page, queries_chunk in enumerate(chunks(queries, 100)):
-                    msg(f"Scanning, got {len(queries_chunk)} stats for {region}, on page {chunk_page+1}, done with {len(stats)} buckets...")
-                    metrics = cw.get_metric_data(
-                        MetricDataQueries=queries_chunk,
-                        StartTime=start_date,
-                        EndTime=start_date + timedelta(days=1)
-                    )
-                    # The metrics are returned in a list, turn it into a dictionary to make things easier
-                    for cur in metrics['MetricDataResults']:
-                        final_metrics[cur['Id']] = cur
-
-                # And for each bucket, pull out the metrics into our final stats object
-                for bucket in buckets[profile][region]:
-                    temp_cur = start_date.strftime("%Y-%m-%d")
-                    for storage, _metric_name, _cost in storages:
-                        temp_metrics = final_metrics['i' + bucket_ids[bucket] + storage]
-                        # Find the metric for the current day, treat lack of a value as 0
-                        value = 0.0
-                        for i in range(len(temp_metrics['Timestamps'])):
-                            if temp_metrics['Timestamps'][i].strftime("%Y-%m-%d") == temp_cur:
-                                value = temp_metrics['Values'][i]
-                                break
-                        # All of the values we want are really integers, so treat them as such
-                        stats[bucket][storage] = int(value)
-
-            # Load cost data if we want to use it
-            if opts.get('s3_cost', False):
-                costs = {}
-                metric_to_cost = {x['cw']: x['desc'] for x in load_s3_cost_classes()}
-                temp = load_pricing_data()
-                # Lookup table to look up a S3 Storage Class to price per GiB
-                for region in buckets[profile]:
-                    if region not in temp:
-                        raise Exception(f"Unknown costs for region {region}!")
-                    costs[region] = {x['cw']: float(temp[region][x['desc']]) for x in load_s3_cost_classes()}
-            else:
-                costs = None
-                metric_to_cost = None
-
-            # Create summary
-            for bucket, bucket_stats in stats.items():
-                # Ignore buckets we've already seen on a previous profile run
-                if "_count" not in bucket_stats:
-                    size, count = 0, 0
-                    for storage, _metric_name, cost in storages:
-                        # Cost elements are storage in bytes, non-cost is the count (should only be one)
-                        if cost:
-                            if costs is None:
-                                size += bucket_stats.get(storage, 0)
-                            else:
-                                # This is (<size> / 1 GiB) * <price per GiB>
-                                size += (bucket_stats.get(storage, 0) / 1073741824) * costs[bucket_to_region[bucket]][storage]
-                        else:
-                            count += bucket_stats.get(storage, 0)
-                    # Store the results
-                    bucket_stats["_count"] = count
-                    bucket_stats["_size"] = size
+                # Call into cloudwatch as few times as possible, each call for
+                # every region runs at once
+                for queries_chunk in chunks(queries, METRIC_QUERIES):
+                    jobs.append(pool.submit(get_metric_data, cw, queries_chunk, start_date))
+
+            # A place to store the metrics we'll gather up, as (timestamp, value) pairs
+            final_metrics = defaultdict(list)
+            for chunk_page, future in enumerate(as_completed(jobs)):
+                progress.message(f"Scanning, got stats for {chunk_page+1} of {len(jobs)} pages of buckets...", temp=True)
+                for _, cur in future.result():
+                    final_metrics[cur['Id']].extend(zip(cur['Timestamps'], cur['Values']))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        # And for each bucket, pull out the metrics into our final stats object
+        stats = defaultdict(dict)
+        bucket_to_region = {}
+        temp_cur = start_date.strftime("%Y-%m-%d")
+        for (profile, region), region_buckets in sorted(regions.items()):
+            for bucket in sorted(region_buckets):
+                bucket_to_region[bucket] = region
+                for storage, _metric_name, _cost in storages:
+                    # Find the metric for the current day, treat lack of a value as 0
+                    value = 0.0
+                    for timestamp, temp_value in final_metrics['i' + bucket_ids[profile, bucket] + storage]:
+                        if timestamp.strftime("%Y-%m-%d") == temp_cur:
+                            value = temp_value
+                            break
+                    # All of the values we want are really integers, so treat them as such
+                    stats[bucket][storage] = int(value)
 
         for bucket, bucket_stats in stats.items():
-            if bucket_stats["_size"] > 0 and bucket_stats["_count"] > 0:
-                total_objects += bucket_stats["_count"]
-                total_size += bucket_stats["_size"]
-                yield [bucket, ""], (bucket_stats["_size"], bucket_stats["_count"])
-
-    msg(f"Done, saw {total_objects} totaling {dump_size(opts, total_size)}", newline=True)
+            # Storage elements are sizes in bytes, the rest is the count (should only be one)
+            size = sum(bucket_stats.get(storage, 0) for storage, _metric_name, is_size in storages if is_size)
+            count = sum(bucket_stats.get(storage, 0) for storage, _metric_name, is_size in storages if not is_size)
+            if size > 0 and count > 0:
+                progress.add(count, size)
+                # CloudWatch doesn't break out the number of objects by storage
+                # type, so that's sent on its own, as a class of every storage
+                # type the bucket uses, then the size of each type
+                used = [storage for storage, _metric_name, is_size in storages if is_size and bucket_stats.get(storage, 0) > 0]
+                yield [bucket], count, 0, ",".join(used) + "@" + bucket_to_region[bucket]
+                for storage in used:
+                    yield [bucket], 0, bucket_stats[storage], storage + "@" + bucket_to_region[bucket]
+
+    progress.stop()
 
 def split(path):
     return path.split('/')
@@ -493,11 +876,30 @@ def get_summary(opts, folder):
             location = "All buckets for " + ", ".join(temp) + " " + ("profile" if len(temp) == 1 else "profiles")
         else:
             location = "All buckets"
-    return [
+    ret = [
         ("Location", location),
         ("Total objects", dump_count(opts, folder.count)),
         ("Total cost" if opts.get('s3_cost', False) else "Total size", dump_size(opts, folder.size)),
     ]
+    if len(opts.get('class_totals', {})) > 0:
+        # The size of everything scanned in each storage class, the region
+        # is dropped from the CloudWatch storage types for all buckets, and
+        # the object counts for all buckets aren't for any one storage type
+        totals = defaultdict(lambda: [0, 0])
+        for row_class, (count, size) in opts['class_totals'].items():
+            if "," in row_class:
+                continue
+            if 's3_bucket' in opts:
+                totals[row_class.split("@")[0]][0] += count
+            totals[row_class.split("@")[0]][1] += size
+        temp = []
+        for storage, (count, size) in sorted(totals.items(), key=lambda x: x[1][1], reverse=True):
+            if count > 0:
+                temp.append(f"{storage} {size_to_string(size)} in {dump_count(opts, count)} objects")
+            else:
+                temp.append(f"{storage} {size_to_string(size)}")
+        ret.append(("Storage classes", ", ".join(temp)))
+    return ret
 
 if __name__ == "__main__":
     print("This module is not meant to be run directly")
@@ -3,6 +3,7 @@
 from datetime import datetime
 from urllib.request import urlopen
 from aws_pager import aws_pager # type: ignore
+from utils import TempMessage
 import boto3
 import gzip
 import json
@@ -13,24 +14,14 @@ else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
 
 DEBUG_REQUESTS = False
 
+_temp_message = TempMessage()
+
 def msg(value, temp=False):
     # Helper to show a message, including temporary status messages
-    if 'last' not in msg.__dict__:
-        msg.last = ""
-    if len(msg.last) > 0:
-        if len(msg.last) > len(value):
-            extra = len(msg.last) - len(value)
-            to_show = "\b" * extra + " " * extra + "\r" + value
-        else:
-            to_show = "\r" + value
-    else:
-        to_show = value
     if temp:
-        print(to_show, end="", flush=True)
-        msg.last = value
+        _temp_message(value, force=True)
     else:
-        print(to_show, flush=True)
-        msg.last = ""
+        _temp_message(value, newline=True)
 
 def cache_json(desc, final, save_data_filename):
     if save_data_filename is None:
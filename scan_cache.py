@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from tree_snapshot import open_snapshot, write_snapshot
+from utils import PathCursor
+import json
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+
+# The cache of scan results, stored in a SQLite database.  One database can hold
+# the results of several scans, each with a row in the options table holding the
+# flags used for that scan, and any details the scanner noted in
+# opts['scan_meta'] while scanning, like the region of a bucket, which are put
+# back in opts['scan_meta'] when the results are used again.
+#
+# Each directory is stored once in the dirs table, as an ID, the ID of its
+# parent, and its name, with 0 being the root.  Once a scan finishes, the totals
+# for everything under each directory are stored along with it, and the root
+# gets a row of its own, with a parent of -1.  Each row in the files table
+# points to a directory, and is either a single object, with a name and no
+# count, or the totals for the objects directly in that directory, with a count
+# and no name.  Rows from scanners that track a class for each object, like S3
+# storage classes, have that class stored with them, otherwise it's NULL.
+#
+# Once a scan is summed up, the tree is also stored in the trees table, as a
+# tree_snapshot split into parts, so later runs can use it without adding up
+# every row again.  Since the tree differs based on per_object, it's stored
+# for each value used.  It also differs based on how the sizes are shown, like
+# costs instead of sizes, which is noted in the snapshot's metadata, a tree
+# that was shown differently is just summed up again.
+#
+# Scanners that store details of their own in the cache, like the local
+# scanner's --incremental, run those statements through cache_execute, so they
+# go through the same connection as the rows, in the same order.  SQLite only
+# lets one connection write at a time, so writing from the scan's connection
+# would have to wait for the writer thread to commit.
+#
+# While a scan is running, scanners that support it can store a checkpoint,
+# a JSON object describing how to pick up the scan, in the checkpoints table.
+# It's written in the same transaction as the rows sent out before it, along
+# with the last row ID in files at that point, so if the scan is interrupted,
+# the next run can drop anything after the checkpoint and resume from it.
+#
+# A scan that has no results of its own can also be answered from a scan that
+# covers more, like a bucket scan for a scan of a prefix in it.  Each
+# abstraction decides that with an optional get_cache_subset(flags, cached)
+# that returns None, or (path, partial, strip): the directory in the cached
+# results to start at, the start of the names to take from it (None for all),
+# and whether to remove the path and partial name from each result.
+#
+# Names are stored as TEXT, except for local file names that aren't valid
+# Unicode, which Python hands over with surrogateescape.  SQLite can't store
+# those as TEXT, so they're stored as a BLOB of the name's bytes instead.
+#
+# The version of the layout is stored in the database's user_version.  Version 1
+# used a single files table with the JSON encoded path of every row, those files
+# are upgraded when they're opened.  Version 2 didn't have the trees table,
+# version 3 didn't have the checkpoints table, version 4 didn't have the
+# indexes to find the contents of a directory, version 5 didn't have the
+# totals for each directory, version 6 didn't have the class of each row, and
+# version 7 didn't have the details noted by the scanner.
+
+SCHEMA_VERSION = 8
+# SQLite limits the size of a single value, so trees are split into parts of this size
+TREE_PART_SIZE = 64 * 1024 * 1024
+# Rows are handed to the writer thread in batches of this many rows
+BATCH_ROWS = 10000
+# How many batches can be waiting for the writer before the scan has to wait
+QUEUE_BATCHES = 32
+# The writer thread commits after this many rows
+COMMIT_ROWS = 250000
+# How often to store a checkpoint, in seconds
+CHECKPOINT_SECONDS = 60
+# How long to wait for another connection to finish writing, in seconds
+LOCK_TIMEOUT = 600
+
+def create_tables(db):
+    db.execute("CREATE TABLE IF NOT EXISTS options(id INTEGER PRIMARY KEY AUTOINCREMENT, flags TEXT NOT NULL, valid INT NOT NULL, meta TEXT);")
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS options_flags_idx ON options(flags);")
+    # Older files don't have the details noted by the scanner
+    if "meta" not in [x[1] for x in db.execute("PRAGMA table_info(options);")]:
+        db.execute("ALTER TABLE options ADD COLUMN meta TEXT;")
+    db.execute("CREATE TABLE IF NOT EXISTS dirs(id INT NOT NULL, dir INT NOT NULL, parent INT NOT NULL, name TEXT NOT NULL, total_count INT, total_size, PRIMARY KEY (id, dir)) WITHOUT ROWID;")
+    # Older files don't have the totals for each directory
+    if "total_count" not in [x[1] for x in db.execute("PRAGMA table_info(dirs);")]:
+        db.execute("ALTER TABLE dirs ADD COLUMN total_count INT;")
+        db.execute("ALTER TABLE dirs ADD COLUMN total_size;")
+    db.execute("CREATE TABLE IF NOT EXISTS files(id INT NOT NULL, dir INT NOT NULL, name TEXT, size NOT NULL, count INT, class TEXT);")
+    # Older files don't have the class of each row
+    if "class" not in [x[1] for x in db.execute("PRAGMA table_info(files);")]:
+        db.execute("ALTER TABLE files ADD COLUMN class TEXT;")
+    db.execute("CREATE INDEX IF NOT EXISTS dirs_parent_idx ON dirs(id, parent, name);")
+    db.execute("CREATE INDEX IF NOT EXISTS dirs_size_idx ON dirs(id, parent, total_size);")
+    # These replaced the indexes on just the ID, and the ID and directory
+    db.execute("DROP INDEX IF EXISTS files_id_idx;")
+    db.execute("DROP INDEX IF EXISTS files_dir_idx;")
+    db.execute("CREATE INDEX IF NOT EXISTS files_size_idx ON files(id, dir, size);")
+    db.execute("CREATE TABLE IF NOT EXISTS checkpoints(id INT NOT NULL PRIMARY KEY, files_rowid INT NOT NULL, state TEXT NOT NULL);")
+    db.execute("CREATE TABLE IF NOT EXISTS trees(id INT NOT NULL, per_object INT NOT NULL, part INT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (id, per_object, part)) WITHOUT ROWID;")
+
+def upgrade_cache(db):
+    version = db.execute("PRAGMA user_version;").fetchone()[0]
+    if version == SCHEMA_VERSION:
+        return
+
+    tables = {x for x, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+    if version == 0 and ("files" in tables or "files_v1" in tables):
+        # A version 1 cache, with a JSON path for each row
+        print("Upgrading cache file to the current format...")
+        if "files_v1" in tables:
+            # An earlier upgrade didn't finish, start it over
+            db.execute("DROP TABLE IF EXISTS files;")
+            db.execute("DROP TABLE IF EXISTS dirs;")
+        else:
+            db.execute("ALTER TABLE files RENAME TO files_v1;")
+        db.execute("DROP INDEX IF EXISTS files_id_idx;")
+        create_tables(db)
+        db.commit()
+
+        # Early version 1 files only stored single objects, without a count column
+        has_count = "count" in [x[1] for x in db.execute("PRAGMA table_info(files_v1);")]
+        for known_id, valid in db.execute("SELECT id, valid FROM options;").fetchall():
+            if valid == 1:
+                writer = CacheWriter(db, known_id)
+                sql = f"SELECT name, size, {'count' if has_count else 'NULL'} FROM files_v1 WHERE id = ? ORDER BY rowid;"
+                for name, size, count in db.execute(sql, (known_id,)):
+                    if count is None:
+                        writer.add((json.loads(name), size))
+                    else:
+                        writer.add((json.loads(name), count, size))
+                writer.finish()
+        db.execute("DROP TABLE files_v1;")
+        db.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        db.commit()
+        # Give back the space the old table used
+        db.execute("VACUUM;")
+    else:
+        create_tables(db)
+        db.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        db.commit()
+
+def connect(fn):
+    # The scan and the writer thread each have their own connection, so use WAL
+    # to let them work at the same time, and wait for the other if need be
+    db = sqlite3.connect(fn, timeout=LOCK_TIMEOUT)
+    db.execute("PRAGMA journal_mode = WAL;")
+    # With WAL, this only syncs on checkpoints, losing the last few commits
+    # after a power loss is fine for a cache
+    db.execute("PRAGMA synchronous = NORMAL;")
+    db.execute("PRAGMA cache_size = -65536;")
+    db.execute("PRAGMA temp_store = MEMORY;")
+    return db
+
+def open_cache(fn):
+    # Open a cache database, creating or upgrading the tables as needed
+    db = connect(fn)
+    upgrade_cache(db)
+    return db
+
+def encode_name(name):
+    # Turn a name into the value stored for it, see the notes at the top
+    if name is None or name.isascii():
+        return name
+    try:
+        name.encode("utf-8")
+        return name
+    except UnicodeEncodeError:
+        return name.encode("utf-8", "surrogateescape")
+
+def decode_name(value):
+    # Turn a stored name back into the name a scanner sent out
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "surrogateescape")
+    return value
+
+def write_batch(db, known_id, dirs, files, other, state):
+    db.executemany(f"INSERT INTO dirs(id, dir, parent, name) VALUES ({known_id}, ?, ?, ?);", dirs)
+    db.executemany(f"INSERT INTO files(id, dir, name, size, count, class) VALUES ({known_id}, ?, ?, ?, ?, ?);", files)
+    # Anything else the scanner wanted written, as (sql, list of values)
+    for sql, values in other:
+        db.executemany(sql, values)
+    if state is not None:
+        # Note where the rows stood, anything after this isn't covered by the checkpoint
+        files_rowid = db.execute("SELECT MAX(rowid) FROM files;").fetchone()[0] or 0
+        db.execute("INSERT OR REPLACE INTO checkpoints(id, files_rowid, state) VALUES (?, ?, ?);", (known_id, files_rowid, json.dumps(state)))
+
+class CacheWriterThread:
+    # Writes batches of rows to the cache on its own thread and connection, so
+    # the scan doesn't stop every time SQLite writes to disk.  The queue is
+    # bounded, if the writer falls behind the scan has to wait for it, and the
+    # time spent waiting is tracked so it can be reported
+    def __init__(self, fn, known_id):
+        self.queue = queue.Queue(QUEUE_BATCHES)
+        self.error = None
+        self.rows = 0
+        self.waits = 0
+        self.waited = 0
+        self.thread = threading.Thread(target=self._worker, args=(fn, known_id), daemon=True)
+        self.thread.start()
+
+    def put(self, dirs, files, other, state):
+        if self.error is not None:
+            raise self.error
+        self.rows += len(dirs) + len(files)
+        try:
+            self.queue.put_nowait((dirs, files, other, state))
+        except queue.Full:
+            started = time.monotonic()
+            self.queue.put((dirs, files, other, state))
+            self.waited += time.monotonic() - started
+            self.waits += 1
+
+    def _worker(self, fn, known_id):
+        try:
+            db = connect(fn)
+            pending = 0
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    break
+                write_batch(db, known_id, *batch)
+                pending += len(batch[0]) + len(batch[1]) + sum(len(x) for _, x in batch[2])
+                # Commit checkpoints right away, so they're not lost if the scan stops
+                if pending >= COMMIT_ROWS or batch[3] is not None:
+                    db.commit()
+                    pending = 0
+            db.commit()
+            db.close()
+        except Exception as e:
+            self.error = e
+            # Keep pulling from the queue so the scan isn't stuck waiting on it
+            while self.queue.get() is not None:
+                pass
+
+    def finish(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+class CacheWriter:
+    # Store rows from a scanner, each directory is stored the first time
+    # it's seen, and each row only refers to it by ID.  If thread is None, the
+    # rows are written to db directly, otherwise they're handed off to thread
+    def __init__(self, db, known_id, thread=None):
+        self.db = db
+        self.known_id = known_id
+        self.thread = thread
+        self.dirs = {}
+        # The parent of each directory, by ID, along with the totals for the
+        # rows directly in it, these are added up once everything is stored
+        self.parents = [-1]
+        self.counts = [0]
+        self.sizes = [0]
+        self.last_checkpoint = time.monotonic()
+        # Like Folder, rows tend to arrive in order, so track the last directory
+        # path seen, and only look up where the next path differs
+        self.cursor = PathCursor(0)
+        self.dir_rows = []
+        self.file_rows = []
+        self.other_rows = []
+        self.other_count = 0
+
+    def _get_dir(self, parent, name):
+        # Find the ID of a directory, storing it if it's the first time it's seen
+        cur = self.dirs.get((parent, name))
+        if cur is None:
+            cur = len(self.parents)
+            self.parents.append(parent)
+            self.counts.append(0)
+            self.sizes.append(0)
+            self.dirs[(parent, name)] = cur
+            self.dir_rows.append((cur, parent, encode_name(name)))
+        return cur
+
+    def _dir_id(self, path, stop):
+        return self.cursor.find(path, stop, self._get_dir)
+
+    def add(self, row):
+        if len(row) == 2:
+            (path, size), count, row_class = row, None, None
+        elif len(row) == 3:
+            (path, count, size), row_class = row, None
+        else:
+            path, count, size, row_class = row
+        if count is None:
+            # A single object, leave the count empty
+            count = 1
+            dir_id = self._dir_id(path, len(path) - 1)
+            self.file_rows.append((dir_id, encode_name(path[-1]), size, None, row_class))
+        else:
+            # This is the total for several objects in a folder, leave the name empty
+            dir_id = self._dir_id(path, len(path))
+            self.file_rows.append((dir_id, None, size, count, row_class))
+        self.counts[dir_id] += count
+        self.sizes[dir_id] += size
+        if len(self.file_rows) >= BATCH_ROWS:
+            self._flush()
+
+    def execute(self, sql, values):
+        # Run a statement along with the rows, after the rows sent out before it
+        if len(self.other_rows) > 0 and self.other_rows[-1][0] == sql:
+            self.other_rows[-1][1].append(values)
+        else:
+            self.other_rows.append((sql, [values]))
+        self.other_count += 1
+        if self.other_count >= BATCH_ROWS:
+            self._flush()
+
+    def load_dirs(self):
+        # When resuming a scan, pick up the directories and totals stored so far
+        for dir_id, parent, name in self.db.execute("SELECT dir, parent, name FROM dirs WHERE id = ? AND dir > 0;", (self.known_id,)):
+            self.dirs[(parent, decode_name(name))] = dir_id
+        self.parents, self.counts, self.sizes = load_dir_totals(self.db, self.known_id)
+
+    def checkpoint(self, get_state):
+        # Called by scanners when everything they've sent out so far could be
+        # resumed from, get_state is only called when a checkpoint is due
+        if time.monotonic() - self.last_checkpoint >= CHECKPOINT_SECONDS:
+            self._flush(get_state())
+            self.last_checkpoint = time.monotonic()
+
+    def _flush(self, state=None):
+        if self.thread is None:
+            write_batch(self.db, self.known_id, self.dir_rows, self.file_rows, self.other_rows, state)
+            self.db.commit()
+        else:
+            self.thread.put(self.dir_rows, self.file_rows, self.other_rows, state)
+        self.dir_rows, self.file_rows, self.other_rows = [], [], []
+        self.other_count = 0
+
+    def finish(self):
+        self._flush()
+        if self.thread is not None:
+            self.thread.finish()
+            if self.thread.waits > 0:
+                print(f"The scan waited {self.thread.waited:.1f}s for the cache writer, {self.thread.waits:,} times")
+        write_dir_totals(self.db, self.known_id, self.parents, self.counts, self.sizes)
+
+def load_dir_totals(db, known_id):
+    # Read back the parent of each directory, and the totals for the rows
+    # directly in it, in the same layout CacheWriter uses
+    parents = [-1]
+    for dir_id, parent in db.execute("SELECT dir, parent FROM dirs WHERE id = ? AND dir > 0 ORDER BY dir;", (known_id,)):
+        if dir_id >= len(parents):
+            # IDs shouldn't have any gaps, but if they do, leave the gaps empty
+            parents.extend([0] * (dir_id + 1 - len(parents)))
+        parents[dir_id] = parent
+    counts, sizes = [0] * len(parents), [0] * len(parents)
+    for dir_id, count, size in db.execute("SELECT dir, SUM(COALESCE(count, 1)), SUM(size) FROM files WHERE id = ? GROUP BY dir;", (known_id,)):
+        counts[dir_id], sizes[dir_id] = count, size
+    return parents, counts, sizes
+
+def write_dir_totals(db, known_id, parents, counts, sizes):
+    # Add everything up, children always have a higher ID than their parent, so
+    # walking backwards sees every child before its parent
+    for dir_id in range(len(parents) - 1, 0, -1):
+        counts[parents[dir_id]] += counts[dir_id]
+        sizes[parents[dir_id]] += sizes[dir_id]
+    db.execute("INSERT OR REPLACE INTO dirs(id, dir, parent, name, total_count, total_size) VALUES (?, 0, -1, '', ?, ?);", (known_id, counts[0], sizes[0]))
+    db.executemany(f"UPDATE dirs SET total_count = ?, total_size = ? WHERE id = {known_id} AND dir = ?;", ((counts[i], sizes[i], i) for i in range(1, len(parents))))
+    db.commit()
+
+def cache_init(opts, flags):
+    known_id, valid = None, False
+    if opts['cache'] is not None:
+        opts['cache_db'] = open_cache(opts['cache'])
+        flags = json.dumps(flags, sort_keys=True)
+        for row in opts['cache_db'].execute("SELECT id, valid FROM options WHERE flags = ?;", (flags,)):
+            known_id, valid = row[0], row[1] == 1
+        if not valid and not opts.get('cache_refresh', False) and not opts['hide_names']:
+            # Before scanning, see if another scan already covers this one
+            subset = find_cache_subset(opts, json.loads(flags))
+            if subset is not None:
+                print(f"Using the results of cached scan #{subset[0]}, which covers this scan")
+                opts['cache_subset'] = subset[1]
+                load_scan_meta(opts, subset[0])
+                return subset[0], True
+        if known_id is None:
+            cur = opts['cache_db'].execute("INSERT INTO options(flags, valid) VALUES (?, 0);", (flags,))
+            opts['cache_db'].commit()
+            known_id = cur.lastrowid
+        elif not valid or opts.get('cache_refresh', False):
+            checkpoint = None
+            if not valid and not opts.get('cache_refresh', False):
+                for row in opts['cache_db'].execute("SELECT files_rowid, state FROM checkpoints WHERE id = ?;", (known_id,)):
+                    checkpoint = row
+            if checkpoint is not None:
+                # The last scan didn't finish, but it left a checkpoint, so drop
+                # anything stored after it, and let the scanner pick up from there
+                print("Resuming the last scan from where it stopped")
+                opts['cache_db'].execute("DELETE FROM files WHERE id = ? AND rowid > ?;", (known_id, checkpoint[0]))
+                opts['cache_resume'] = json.loads(checkpoint[1])
+            else:
+                # Either the last scan didn't finish, or the scanner wants to run
+                # again even if it did, so clear out the old results
+                opts['cache_db'].execute("UPDATE options SET valid=0 WHERE id=?;", (known_id,))
+                opts['cache_db'].execute("DELETE FROM files WHERE id = ?;", (known_id,))
+                opts['cache_db'].execute("DELETE FROM dirs WHERE id = ?;", (known_id,))
+                opts['cache_db'].execute("DELETE FROM checkpoints WHERE id = ?;", (known_id,))
+            opts['cache_db'].execute("DELETE FROM trees WHERE id = ?;", (known_id,))
+            opts['cache_db'].commit()
+            valid = False
+        opts['cache_known_id'] = known_id
+        if not valid:
+            opts['cache_writer'] = CacheWriter(opts['cache_db'], known_id, CacheWriterThread(opts['cache'], known_id))
+            if opts.get('cache_resume') is not None:
+                opts['cache_writer'].load_dirs()
+            opts['cache_checkpoint'] = opts['cache_writer'].checkpoint
+            opts['cache_execute'] = opts['cache_writer'].execute
+        else:
+            load_scan_meta(opts, known_id)
+    return known_id, valid
+
+def load_scan_meta(opts, known_id):
+    # Put back the details the scanner noted for a finished scan
+    for meta, in opts['cache_db'].execute("SELECT meta FROM options WHERE id = ?;", (known_id,)):
+        if meta is not None:
+            opts['scan_meta'] = json.loads(meta)
+
+def find_dir(db, known_id, path):
+    # Find the ID of a directory, or None if it's not in the cache
+    dir_id = 0
+    for name in path:
+        row = db.execute("SELECT dir FROM dirs WHERE id = ? AND parent = ? AND name = ?;", (known_id, dir_id, encode_name(name))).fetchone()
+        if row is None:
+            return None
+        dir_id = row[0]
+    return dir_id
+
+def find_cache_subset(opts, flags):
+    # Look for a finished scan that covers this one, returns the ID of that scan
+    # and the details from get_cache_subset, or None
+    get_cache_subset = getattr(opts['target'], "get_cache_subset", None)
+    if get_cache_subset is None:
+        return None
+
+    best = None
+    for known_id, cached in opts['cache_db'].execute("SELECT id, flags FROM options WHERE valid = 1;").fetchall():
+        cached = json.loads(cached)
+        if cached.get('target_switch') != flags.get('target_switch'):
+            continue
+        subset = get_cache_subset(flags, cached)
+        if subset is None:
+            continue
+        if subset[1] is None and find_dir(opts['cache_db'], known_id, subset[0]) is None:
+            # The cached scan never saw anything in this directory, it might have
+            # been skipped, so don't trust it
+            continue
+        # Prefer the scan closest to this one, it has the least to look through
+        if best is None or len(subset[0]) > len(best[1][0]):
+            best = (known_id, subset)
+    return best
+
+def cache_add(opts, row):
+    opts['cache_writer'].add(row)
+
+def cache_finish(opts, known_id):
+    opts['cache_writer'].finish()
+    opts['cache_db'].execute("DELETE FROM checkpoints WHERE id = ?;", (known_id,))
+    opts['cache_db'].execute("UPDATE options SET valid=1, meta=? WHERE id=?;", (json.dumps(opts['scan_meta'], sort_keys=True), known_id))
+    opts['cache_db'].commit()
+
+def make_row(path, name, size, count, row_class):
+    # Turn a row from the files table back into a row like a scanner returns
+    name = decode_name(name)
+    if row_class is not None:
+        return (path if name is None else path + [name]), count, size, row_class
+    elif count is None:
+        return path + [name], size
+    else:
+        return path, count, size
+
+def cache_get(opts, known_id):
+    # Build up the path for each directory first, parents always have a lower ID
+    # than their children, so each parent is known by the time a child is seen
+    paths = {0: []}
+    for dir_id, parent, name in opts['cache_db'].execute("SELECT dir, parent, name FROM dirs WHERE id = ? AND dir > 0 ORDER BY dir;", (known_id,)):
+        paths[dir_id] = paths[parent] + [decode_name(name)]
+
+    for dir_id, name, size, count, row_class in opts['cache_db'].execute("SELECT dir, name, size, count, class FROM files WHERE id = ?;", (known_id,)):
+        yield make_row(paths[dir_id], name, size, count, row_class)
+
+def cache_save_tree(opts, known_id, folder, meta={}):
+    # Store the summed up tree, replacing any older copy, meta is stored with it
+    db, per_object = opts['cache_db'], 1 if opts['per_object'] else 0
+    db.execute("DELETE FROM trees WHERE id = ? AND per_object = ?;", (known_id, per_object))
+    with tempfile.TemporaryFile() as f:
+        write_snapshot(folder, f, dict(meta, per_object=opts['per_object']))
+        f.seek(0)
+        part = 0
+        while True:
+            data = f.read(TREE_PART_SIZE)
+            if len(data) == 0:
+                break
+            db.execute("INSERT INTO trees(id, per_object, part, data) VALUES (?, ?, ?, ?);", (known_id, per_object, part, data))
+            part += 1
+    db.commit()
+
+def cache_get_tree(opts, known_id):
+    # Load the summed up tree if one was stored, otherwise return None
+    db, per_object = opts['cache_db'], 1 if opts['per_object'] else 0
+    sql = "SELECT data FROM trees WHERE id = ? AND per_object = ? ORDER BY part;"
+    with tempfile.TemporaryFile() as f:
+        for data, in db.execute(sql, (known_id, per_object)):
+            f.write(data)
+        if f.tell() == 0:
+            return None
+        f.flush()
+        return open_snapshot(f)
+
+def cache_get_subset(opts, known_id, subset):
+    # Like cache_get, but only the part of the cached results picked out by
+    # get_cache_subset
+    db = opts['cache_db']
+    path, partial, strip = subset
+    dir_id = find_dir(db, known_id, path)
+    if dir_id is None:
+        return
+
+    base = [] if strip else list(path)
+    todo = deque()
+    if partial is None:
+        todo.append((dir_id, base))
+    else:
+        # Only the entries in this directory whose names start with partial, the
+        # last character possible marks the end of that range
+        cut = len(partial) if strip else 0
+        end = partial + "\U0010ffff"
+        for name, size, row_class in db.execute("SELECT name, size, class FROM files WHERE id = ? AND dir = ? AND name >= ? AND name < ?;", (known_id, dir_id, partial, end)):
+            yield make_row(base, decode_name(name)[cut:], size, None, row_class)
+        if len(partial) == 0:
+            # Totals for the objects in the directory itself can only be used
+            # if every name in it is wanted
+            for size, count, row_class in db.execute("SELECT size, count, class FROM files WHERE id = ? AND dir = ? AND name IS NULL;", (known_id, dir_id)):
+                yield make_row(base, None, size, count, row_class)
+        for sub_id, name in db.execute("SELECT dir, name FROM dirs WHERE id = ? AND parent = ? AND name >= ? AND name < ?;", (known_id, dir_id, partial, end)):
+            todo.append((sub_id, base + [decode_name(name)[cut:]]))
+
+    while len(todo) > 0:
+        dir_id, path = todo.pop()
+        for name, size, count, row_class in db.execute("SELECT name, size, count, class FROM files WHERE id = ? AND dir = ?;", (known_id, dir_id)):
+            yield make_row(path, name, size, count, row_class)
+        for sub_id, name in db.execute("SELECT dir, name FROM dirs WHERE id = ? AND parent = ?;", (known_id, dir_id)):
+            todo.append((sub_id, path + [decode_name(name)]))
+
+def cache_find(opts, flags):
+    # Find a finished scan for these flags without scanning, either one for the
+    # same flags, or one that covers them.  Returns the ID of the scan and the
+    # path inside of it these flags start at, or None
+    db = opts['cache_db']
+    for known_id, in db.execute("SELECT id FROM options WHERE flags = ? AND valid = 1;", (json.dumps(flags, sort_keys=True),)):
+        return known_id, []
+    subset = find_cache_subset(opts, flags)
+    if subset is not None:
+        known_id, (path, partial, strip) = subset
+        # Only subsets that are an entire directory can be treated as a path
+        if strip and partial in (None, ""):
+            return known_id, path
+    return None
+
+def cache_query(opts, known_id, path, top):
+    # Look up the totals for a single directory and its largest children,
+    # without loading the rest of the tree.  Returns None if the directory
+    # doesn't exist, otherwise (count, size, children), where children is a
+    # list of (name, is_dir, count, size), largest first.  A name of None is
+    # the totals for the objects directly in the directory, if the scanner only
+    # sent out totals for each directory
+    db = opts['cache_db']
+    row = db.execute("SELECT total_count FROM dirs WHERE id = ? AND dir = 0;", (known_id,)).fetchone()
+    if row is None or row[0] is None:
+        # This scan was stored before the totals were, work them out now
+        write_dir_totals(db, known_id, *load_dir_totals(db, known_id))
+
+    dir_id = find_dir(db, known_id, path)
+    if dir_id is None:
+        return None
+    count, size = db.execute("SELECT total_count, total_size FROM dirs WHERE id = ? AND dir = ?;", (known_id, dir_id)).fetchone()
+
+    # Pick the largest from each source, the indexes return these in order
+    children = []
+    for name, sub_count, sub_size in db.execute("SELECT name, total_count, total_size FROM dirs WHERE id = ? AND parent = ? ORDER BY total_size DESC LIMIT ?;", (known_id, dir_id, top)):
+        children.append((decode_name(name), True, sub_count, sub_size))
+    for name, sub_size, sub_count in db.execute("SELECT name, size, count FROM files WHERE id = ? AND dir = ? ORDER BY size DESC LIMIT ?;", (known_id, dir_id, top)):
+        children.append((decode_name(name), False, 1 if sub_count is None else sub_count, sub_size))
+    children.sort(key=lambda x: x[3], reverse=True)
+    return count, size, children[:top]
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
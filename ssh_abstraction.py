@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
-from utils import TempMessage, size_to_string, count_to_string, register_abstraction
+from utils import Progress, flags_match_except, size_to_string, count_to_string, register_abstraction
 import base64
 import gzip
 import hashlib
 import json
 import os
+import posixpath
 import textwrap
 try:
     # Use paramiko for this connection, so wrap the import 
@@ -100,12 +101,13 @@ def get_remote_script(opts):
                 if "SCANNER_END" in row:
                     in_scanner = False
             if in_scanner:
-                if not row.strip().startswith("#") and len(row.strip()) > 0 and "msg" not in row:
+                # Progress isn't shown on the remote machine, so skip those lines
+                if not row.strip().startswith("#") and len(row.strip()) > 0 and "progress" not in row:
                     script += row
 
     # Add a small helper that calls the local function
     script += textwrap.dedent("""
-        import json,os,gzip,base64,sys,hashlib
+        import json,os,gzip,base64,sys,hashlib,time
         class Batch:
             def __init__(self):
                 self.batch=[]
@@ -124,8 +126,15 @@ def get_remote_script(opts):
                 xlen=f"{len(x):0x}"
                 sys.stdout.write(f"{len(xlen):0x}{xlen}{x}")
                 sys.stdout.flush()
+        class Checkpoint:
+            def __init__(self):
+                self.last=time.time()
+            def __call__(self,get_state):
+                if time.time()-self.last>=30:
+                    self.last=time.time()
+                    b.append({"checkpoint":get_state()})
         b=Batch()
-        for x in scan_folder({'lfs_base':os.path.expanduser("""+json.dumps(opts["ssh_path"])+""")}):
+        for x in walk_folder({'lfs_base':os.path.expanduser("""+json.dumps(opts["ssh_path"])+"""),'per_object':"""+str(opts['per_object'])+""",'cache_resume':json.loads("""+json.dumps(json.dumps(opts.get('cache_resume')))+"""),'cache_checkpoint':Checkpoint() if """+str('cache_checkpoint' in opts)+""" else None}):
             b.append(x)
         b.append("DONE")
         b.dump()
@@ -140,6 +149,23 @@ def get_remote_script(opts):
 
     return remote_code
 
+def get_cache_subset(flags, cached):
+    # A cached scan of a directory on the same machine that this one is inside of
+    # has already seen everything under it.  Paths are only compared as strings,
+    # nothing is checked on the remote machine
+    if not flags_match_except(flags, cached, 'ssh_path'):
+        return None
+    path, cached_path = posixpath.normpath(flags['ssh_path']), posixpath.normpath(cached['ssh_path'])
+    if path.startswith("~") != cached_path.startswith("~") or posixpath.isabs(path) != posixpath.isabs(cached_path):
+        return None
+    rel = posixpath.relpath(path, cached_path)
+    if rel == posixpath.curdir:
+        return [], None, True
+    parts = rel.split("/")
+    if parts[0] == posixpath.pardir:
+        return None
+    return parts, None, True
+
 def scan_folder(opts):
     # Connect to the remote machine
     ssh = paramiko.SSHClient()
@@ -159,8 +185,8 @@ def scan_folder(opts):
 
     remote_code = get_remote_script(opts)
 
-    msg = TempMessage()
-    msg("Scanning...", force=True)
+    progress = Progress(dump_size=lambda value: dump_size(opts, value))
+    progress.start()
 
     # Build up a command to run, use "python3" if it exists, otherwise fall back to "python" and a hope
     # It does require Python v3.6 or greater to run
@@ -168,7 +194,6 @@ def scan_folder(opts):
 
     stdin, stdout, stderr = ssh.exec_command(cmd)
     read_done = False
-    total_objects, total_size = 0, 0
     while not read_done:
         # Ok, the remote script is running, go ahead and read one batch at a time
         to_read_len = stdout.read(1)
@@ -191,11 +216,15 @@ def scan_folder(opts):
         for row in data:
             if row == "DONE":
                 read_done = True
+            elif isinstance(row, dict):
+                # The remote scanner can be resumed from this point, the state
+                # it sent is passed back to it if that happens
+                if 'cache_checkpoint' in opts:
+                    opts['cache_checkpoint'](lambda: row['checkpoint'])
             else:
-                total_objects += 1
-                total_size += row[1]
-                yield row
-        msg(f"Scanning, gathered {total_objects} totaling {dump_size(opts, total_size)}...")
+                # Either (path, size) for an object, or (path, count, size) for a folder
+                progress.add(1 if len(row) == 2 else row[1], row[-1])
+                yield tuple(row)
 
     error_output = stderr.read()
     if len(error_output) > 0:
@@ -206,7 +235,7 @@ def scan_folder(opts):
     stderr.close()
     ssh.close()
 
-    msg(f"Done, saw {total_objects} totaling {dump_size(opts, total_size)}", newline=True)
+    progress.stop()
 
 def split(path):
     # Hardcoded to use forward slashes
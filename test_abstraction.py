@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+from collections import defaultdict
 from utils import size_to_string, count_to_string, register_abstraction
 register_abstraction(__name__)
 
@@ -27,8 +28,20 @@ def scan_folder(opts):
         ("sub_b/003",  130),
         ("sub_c/004",  140),
     ]
-    for key, value in temp:
-        yield key.split("/"), value
+    if opts['per_object']:
+        # Each object is shown, so send out a (path, size) row for each one
+        for key, value in temp:
+            yield key.split("/"), value
+    else:
+        # Otherwise, it's enough to send out a (path, count, size) row with the
+        # totals for the objects directly in each folder
+        totals = defaultdict(lambda: [0, 0])
+        for key, value in temp:
+            folder = tuple(key.split("/")[:-1])
+            totals[folder][0] += 1
+            totals[folder][1] += value
+        for folder, (count, size) in totals.items():
+            yield list(folder), count, size
 
 def split(path):
     # Hardcoded to use forward slashes
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dir_sizer
+import scan_cache
+from tree_snapshot import load_snapshot
+
+# More directories than the rows the cache writer takes in a batch, so the
+# writer has a transaction open while the scan is still storing directory details
+DIR_COUNT = 1200
+
+def make_tree(base):
+    for i in range(DIR_COUNT):
+        path = os.path.join(base, f"d{i // 100}", f"e{i}")
+        os.makedirs(path)
+        with open(os.path.join(path, "f"), "wb") as f:
+            f.write(b"x" * (i % 7 + 1))
+
+def run(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["dir_sizer.py", "--no_output"] + list(args))
+    dir_sizer.main()
+
+def totals(fn):
+    snap = load_snapshot(fn)
+    return snap.count, snap.size, sorted((name, sub.count, sub.size) for name, sub in snap.sub.items())
+
+def test_incremental_many_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(scan_cache, "BATCH_ROWS", 100)
+    # Fail quickly if the scan ends up waiting on the writer
+    monkeypatch.setattr(scan_cache, "LOCK_TIMEOUT", 5)
+    base, cache = str(tmp_path / "tree"), str(tmp_path / "cache.db")
+    make_tree(base)
+
+    run(monkeypatch, "--save_snapshot", str(tmp_path / "full.snap"), "--local", "--base", base)
+    run(monkeypatch, "--cache", cache, "--save_snapshot", str(tmp_path / "first.snap"), "--local", "--base", base, "--incremental")
+    with open(os.path.join(base, "d3", "e300", "g"), "wb") as f:
+        f.write(b"y" * 10)
+    run(monkeypatch, "--save_snapshot", str(tmp_path / "full2.snap"), "--local", "--base", base)
+    run(monkeypatch, "--cache", cache, "--save_snapshot", str(tmp_path / "second.snap"), "--local", "--base", base, "--incremental")
+
+    assert totals(str(tmp_path / "first.snap")) == totals(str(tmp_path / "full.snap"))
+    assert totals(str(tmp_path / "second.snap")) == totals(str(tmp_path / "full2.snap"))
+    # Every directory's details were stored, and nothing from the first scan was left behind
+    db = scan_cache.open_cache(cache)
+    assert db.execute("SELECT COUNT(*), COUNT(DISTINCT gen) FROM dir_state;").fetchone() == (DIR_COUNT + 13, 1)
+    db.close()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+from collections import deque
+import json
+import mmap
+import shutil
+import struct
+import tempfile
+
+# A compact binary snapshot of a summed up tree, like utils.Folder or
+# compact_tree.CompactFolder, that can be memory mapped and used without
+# parsing or loading the entire file.
+#
+# The layout is:
+#
+#   Header, see HEADER below
+#   Node records, one fixed size record per node, in breadth first order, so
+#     the children of each node are one contiguous run of records, and sorted
+#     by name, so a child can be found with a binary search.  Node 0 is the root.
+#   String table, the UTF-8 names of every node, one after the other
+#   Metadata, a JSON object with details on how the tree was created
+#
+# Each node record is (name offset, name length, child count, first child,
+# count, size).  The size is stored as a double if any size in the tree
+# wasn't an integer, like with costs, otherwise as a 64-bit integer.
+
+MAGIC = b"DIRSIZER"
+VERSION = 1
+FLAG_FLOAT_SIZES = 1
+
+# magic, version, flags, node count, nodes offset, names offset, metadata offset, metadata length
+HEADER = struct.Struct("<8sIIQQQQQ")
+INT_RECORD = struct.Struct("<QIIQqq")
+FLOAT_RECORD = struct.Struct("<QIIQqd")
+
+def _encode(value):
+    # Local file names might not be valid Unicode, so let them round trip
+    return value.encode("utf-8", "surrogateescape")
+
+def _decode(value):
+    return value.decode("utf-8", "surrogateescape")
+
+def save_snapshot(folder, fn, meta):
+    # Write out a summed up tree to fn, meta is stored along with it
+    with open(fn, "wb") as f:
+        write_snapshot(folder, f, meta)
+
+def write_snapshot(folder, f, meta):
+    # Write out a summed up tree to a seekable binary file object
+    flags = FLAG_FLOAT_SIZES if isinstance(folder.size, float) else 0
+    record = FLOAT_RECORD if flags & FLAG_FLOAT_SIZES else INT_RECORD
+
+    with tempfile.TemporaryFile() as names:
+        # Leave room for the header, it's filled in once everything else is known
+        f.write(b"\0" * HEADER.size)
+        nodes_offset = f.tell()
+
+        node_count, next_idx, name_offset = 0, 1, 0
+        todo = deque([("", folder)])
+        while len(todo) > 0:
+            name, cur = todo.popleft()
+            name = _encode(name)
+            children = sorted(cur.sub.items(), key=lambda x: _encode(x[0]))
+            f.write(record.pack(name_offset, len(name), len(children), next_idx, cur.count, cur.size))
+            names.write(name)
+            name_offset += len(name)
+            next_idx += len(children)
+            node_count += 1
+            todo.extend(children)
+
+        names_offset = f.tell()
+        names.seek(0)
+        shutil.copyfileobj(names, f)
+
+        meta_offset = f.tell()
+        meta = json.dumps(meta).encode("utf-8")
+        f.write(meta)
+
+        end = f.tell()
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, flags, node_count, nodes_offset, names_offset, meta_offset, len(meta)))
+        f.seek(end)
+
+class SnapshotNode:
+    # A view of a single node in a snapshot, offers the same interface as Folder
+    # that the layout code and abstractions use
+    __slots__ = ("snap", "idx")
+    def __init__(self, snap, idx):
+        self.snap = snap
+        self.idx = idx
+
+    @property
+    def count(self):
+        return self.snap._record(self.idx)[4]
+
+    @property
+    def size(self):
+        return self.snap._record(self.idx)[5]
+
+    @property
+    def sub(self):
+        return SnapshotChildren(self.snap, self.idx)
+
+    def __getitem__(self, key):
+        return self.sub[key]
+
+    def __iter__(self):
+        return iter(self.sub.items())
+
+class SnapshotChildren:
+    # A read only view of the children of a node, acts like the dictionary in Folder.sub
+    __slots__ = ("snap", "start", "end")
+    def __init__(self, snap, idx):
+        _, _, child_count, first_child, _, _ = snap._record(idx)
+        self.snap = snap
+        self.start = first_child
+        self.end = first_child + child_count
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _find(self, key):
+        # Children are sorted by name, so use a binary search
+        key = _encode(key)
+        lo, hi = self.start, self.end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.snap._name_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.end and self.snap._name_bytes(lo) == key:
+            return lo
+        return -1
+
+    def __getitem__(self, key):
+        idx = self._find(key)
+        if idx < 0:
+            raise KeyError(key)
+        return SnapshotNode(self.snap, idx)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        for idx in range(self.start, self.end):
+            yield _decode(self.snap._name_bytes(idx))
+
+    def values(self):
+        for idx in range(self.start, self.end):
+            yield SnapshotNode(self.snap, idx)
+
+    def items(self):
+        for idx in range(self.start, self.end):
+            yield _decode(self.snap._name_bytes(idx)), SnapshotNode(self.snap, idx)
+
+class SnapshotFolder(SnapshotNode):
+    # The root of a snapshot, data is anything that supports the buffer
+    # protocol, like a memory mapped file or a bytes object
+    __slots__ = ("data", "record", "node_count", "nodes_offset", "names_offset", "meta")
+    def __init__(self, data):
+        super().__init__(self, 0)
+        self.data = data
+        magic, version, flags, self.node_count, self.nodes_offset, self.names_offset, meta_offset, meta_len = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise Exception("ERROR: Not a tree snapshot")
+        if version != VERSION:
+            raise Exception(f"ERROR: Unknown tree snapshot version {version}")
+        self.record = FLOAT_RECORD if flags & FLAG_FLOAT_SIZES else INT_RECORD
+        self.meta = json.loads(bytes(data[meta_offset:meta_offset + meta_len]))
+
+    def _record(self, idx):
+        return self.record.unpack_from(self.data, self.nodes_offset + idx * self.record.size)
+
+    def _name_bytes(self, idx):
+        name_offset, name_len = self._record(idx)[:2]
+        name_offset += self.names_offset
+        return bytes(self.data[name_offset:name_offset + name_len])
+
+def load_snapshot_meta(fn):
+    # Just read the metadata from a snapshot file
+    with open(fn, "rb") as f:
+        header = f.read(HEADER.size)
+        magic, _, _, _, _, _, meta_offset, meta_len = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise Exception("ERROR: Not a tree snapshot")
+        f.seek(meta_offset)
+        return json.loads(f.read(meta_len))
+
+def load_snapshot(fn):
+    # Memory map a snapshot file, only the parts of it that are used are read
+    with open(fn, "rb") as f:
+        return open_snapshot(f)
+
+def open_snapshot(f):
+    # Memory map a snapshot from an open file object, the map stays valid after
+    # the file is closed
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return SnapshotFolder(data)
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
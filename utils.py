@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, deque
+import contextlib
+import functools
+import hashlib
+import itertools
 import json
-import random
+import queue
 import string
 import sys
+import threading
+import time
 if sys.version_info >= (3, 11): from datetime import UTC
 else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
 
@@ -60,13 +66,232 @@ class TempMessage:
         else:
             print(temp + msg, end="", flush=True)
 
+class Progress:
+    # Track the progress of a scan.  Scanners only bump the counters, and a background
+    # thread shows the totals, rates, and estimated time left at a fixed interval, so
+    # checking the clock and building strings stays out of the scanner's loop
+    def __init__(self, dump_size=size_to_string, interval=timedelta(seconds=1), detail=None):
+        self.count = 0
+        self.size = 0
+        # The number of objects expected, if it's known, used to estimate the time left
+        self.expected = None
+        self.dump_size = dump_size
+        self.interval = interval.total_seconds()
+        # An optional function returning extra details to show
+        self.detail = detail
+        self.msg = TempMessage()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, count, size):
+        self.count += count
+        self.size += size
+
+    def message(self, value, temp=False):
+        # Show a message, a temporary message will be replaced by the next one
+        with self.lock:
+            if temp:
+                self.msg(value, force=True)
+            else:
+                self.msg(value, newline=True)
+
+    def start(self):
+        # Start showing the progress in the background
+        self.message("Scanning...", temp=True)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Stop the background thread and show the final totals
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.message(self._describe(f"Done, saw {self.count} totaling {self.dump_size(self.size)}"))
+
+    def _describe(self, value):
+        if self.detail is not None:
+            value += ", " + self.detail()
+        return value
+
+    def _worker(self):
+        last_at, last_count, last_size = time.monotonic(), self.count, self.size
+        count_rate, size_rate = None, None
+        while not self.stopped.wait(self.interval):
+            now, count, size = time.monotonic(), self.count, self.size
+            # Smooth out the rates so the display doesn't jump around
+            temp_count = (count - last_count) / (now - last_at)
+            temp_size = (size - last_size) / (now - last_at)
+            if count_rate is None:
+                count_rate, size_rate = temp_count, temp_size
+            else:
+                count_rate = count_rate * 0.7 + temp_count * 0.3
+                size_rate = size_rate * 0.7 + temp_size * 0.3
+            last_at, last_count, last_size = now, count, size
+
+            value = f"Scanning, gathered {count} totaling {self.dump_size(size)}"
+            value += f", {count_to_string(int(count_rate))} objects/s"
+            value += f", {self.dump_size(int(size_rate) if isinstance(size, int) else size_rate)}/s"
+            if self.expected is not None and count_rate > 0:
+                left = max(0, self.expected - count) / count_rate
+                value += f", ETA {timedelta(seconds=int(left))}"
+            self.message(self._describe(value) + "...", temp=True)
+
+class AdaptiveLimit:
+    # Limit how many requests run at once, and tune that limit as they finish.
+    # The limit grows by about one each time that many requests finish, and is
+    # cut in half when a request is throttled, or when requests start taking
+    # much longer than they used to, which is a sign the other end is busy.
+    # Cuts only happen once for each round trip, so a burst of throttled
+    # requests sent at the same time only counts once
+    def __init__(self, most, least=1, slow=3.0):
+        self.most = most
+        self.least = least
+        # How many times longer than usual requests can take before backing off
+        self.slow = slow
+        self.limit = float(most)
+        self.active = 0
+        self.throttles = 0
+        # The smoothed time requests are taking, and the usual time they take,
+        # which creeps up if requests stay slow, so that becomes the new usual
+        self.latency = None
+        self.usual = None
+        self.last_cut = 0
+        self.cond = threading.Condition()
+
+    def allowed(self):
+        return max(self.least, int(self.limit))
+
+    @contextlib.contextmanager
+    def request(self):
+        # Wait for room, then run one request inside the with block
+        with self.cond:
+            while self.active >= self.allowed():
+                self.cond.wait()
+            self.active += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._finished(time.monotonic() - started)
+
+    def throttled(self):
+        # Called when the other end asks to slow down, even if the request is
+        # retried and works in the end
+        with self.cond:
+            self.throttles += 1
+            self._cut()
+
+    def _finished(self, latency):
+        with self.cond:
+            self.active -= 1
+            if self.latency is None:
+                self.latency = self.usual = latency
+            else:
+                self.latency = self.latency * 0.8 + latency * 0.2
+                self.usual = min(self.latency, self.usual + (self.latency - self.usual) * 0.01)
+            if self.latency > self.usual * self.slow:
+                self._cut()
+            else:
+                self.limit = min(self.most, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def _cut(self):
+        now = time.monotonic()
+        if now - self.last_cut >= (self.latency or 0):
+            self.limit = max(self.least, self.limit / 2)
+            self.last_cut = now
+
+    def describe(self):
+        # A short description of the current state, to show with the progress
+        value = f"{self.allowed()} of {self.most} requests at once"
+        if self.throttles > 0:
+            value += f", throttled {count_to_string(self.throttles)} times"
+        return value
+
+class JobQueue:
+    # Runs jobs on a thread pool, and hands back their results one at a time on
+    # the calling thread, so the results can be used like a single stream.  A
+    # job is waiting until the caller is done with its result, and results can
+    # queue more jobs, so the waiting jobs are what's left to do if a scan is
+    # resumed.  If most is given, only that many jobs are handed to the pool at
+    # once, so finished results don't pile up if they're used slower than they
+    # arrive
+    def __init__(self, pool, func, most=None):
+        self.pool = pool
+        self.func = func
+        self.most = most
+        self.waiting = {}
+        # The jobs in waiting that haven't been handed to the pool yet
+        self.pending = deque()
+        # Each finished job is posted here, along with its future
+        self.done = queue.Queue()
+        self.job_ids = itertools.count()
+
+    def add(self, job):
+        job_id = next(self.job_ids)
+        self.waiting[job_id] = job
+        self.pending.append(job_id)
+        self._fill()
+
+    def _fill(self):
+        # Hand jobs to the pool while there's room
+        while len(self.pending) > 0 and (self.most is None or len(self.waiting) - len(self.pending) < self.most):
+            job_id = self.pending.popleft()
+            future = self.pool.submit(self.func, self.waiting[job_id])
+            future.add_done_callback(lambda x, job_id=job_id: self.done.put((job_id, x)))
+
+    def results(self, checkpoint=None, key="todo"):
+        # Enumerate (job, result) as each job finishes, until no jobs are left.
+        # If checkpoint is given, it's called with the waiting jobs under key
+        # each time they're exactly what's left to do
+        while len(self.waiting) > 0:
+            self._fill()
+            if checkpoint is not None:
+                checkpoint(lambda: {key: list(self.waiting.values())})
+            job_id, future = self.done.get()
+            yield self.waiting[job_id], future.result()
+            del self.waiting[job_id]
+
+class PathCursor:
+    # Remembers the path of the last item added to a tree, and the node for each
+    # folder along it.  Items tend to arrive in order, so most share a long
+    # prefix with the last item added, only walk down from where the paths differ
+    __slots__ = ("keys", "nodes")
+    def __init__(self, root):
+        self.keys = []
+        self.nodes = [root]
+
+    def find(self, path, stop, get_child):
+        # Find the node for path[:stop], get_child(node, key) returns the child
+        # of node with that name, creating it if needed
+        keys, nodes = self.keys, self.nodes
+        depth = 0
+        limit = min(len(keys), stop)
+        while depth < limit and keys[depth] == path[depth]:
+            depth += 1
+        del keys[depth:]
+        del nodes[depth + 1:]
+        cur = nodes[depth]
+        for i in range(depth, stop):
+            key = path[i]
+            cur = get_child(cur, key)
+            keys.append(key)
+            nodes.append(cur)
+        return cur
+
 class Folder:
-    __slots__ = ("count", "size", "sub", "opts")
+    __slots__ = ("count", "size", "sub", "opts", "cursor")
     def __init__(self, opts):
         self.opts = opts
         self.count = 0
         self.size = 0
         self.sub = defaultdict(lambda: Folder(opts))
+        # The path of the last item added, and the folders along that path, only
+        # used on the folder items are added to
+        self.cursor = None
 
     def __getitem__(self, key):
         return self.sub[key]
@@ -74,24 +299,60 @@ class Folder:
     def __iter__(self):
         return iter(self.sub.items())
 
+    @staticmethod
+    def _get_child(folder, key):
+        return folder.sub[key]
+
+    def _find(self, path, stop):
+        # Find the folder for path[:stop], creating it if needed
+        if self.cursor is None:
+            self.cursor = PathCursor(self)
+        return self.cursor.find(path, stop, Folder._get_child)
+
     def add(self, filename, size):
-        if len(filename) == (0 if self.opts["per_object"] else 1):
-            if isinstance(size, tuple):
-                self.count += size[1]
-                self.size += size[0]
-            else:
-                self.count += 1
-                self.size += size
+        cur = self._find(filename, len(filename) - (0 if self.opts["per_object"] else 1))
+        if isinstance(size, tuple):
+            cur.count += size[1]
+            cur.size += size[0]
         else:
-            self[filename[0]].add(filename[1:], size)
+            cur.count += 1
+            cur.size += size
+
+    def add_dir(self, path, count, size):
+        # Add the totals for several objects directly inside of a folder
+        cur = self._find(path, len(path))
+        cur.count += count
+        cur.size += size
+
+    def add_row(self, row):
+        # Add a row from a scanner, either (path, size) for a single object, or
+        # (path, count, size) for the total of the objects directly in a folder
+        if len(row) == 3:
+            self.add_dir(*row)
+        else:
+            self.add(*row)
+
+    def walk(self, path=[]):
+        # Enumerate the totals for the objects added directly to each folder as
+        # (path, count, size) rows, this is only meaningful before sum_up is called
+        todo = [(path, self)]
+        while len(todo) > 0:
+            path, cur = todo.pop()
+            if cur.count > 0:
+                yield path, cur.count, cur.size
+            todo.extend((path + [key], value) for key, value in reversed(cur.sub.items()))
 
     def sum_up(self):
-        count, size = self.count, self.size
-        for sub in self.sub.values():
-            sub.sum_up()
-            count += sub.count
-            size += sub.size
-        self.count, self.size = count, size
+        # Find every folder first, without recursing, so very deep trees work, then
+        # total them up in reverse order so each child is done before its parent
+        order = [self]
+        for cur in order:
+            order.extend(cur.sub.values())
+        for cur in reversed(order):
+            for sub in cur.sub.values():
+                cur.count += sub.count
+                cur.size += sub.size
+        self.cursor = None
     
     def dump(self, f, key=""):
         if len(self.sub) == 0:
@@ -109,13 +370,13 @@ class Folder:
         else:
             key, self.count, self.size, left = row
             for _ in range(left):
-                temp = Folder()
+                temp = Folder(self.opts)
                 self.sub[temp._load(f)] = temp
             return key
 
     @staticmethod
-    def load(f):
-        ret = Folder()
+    def load(f, opts):
+        ret = Folder(opts)
         ret._load(f)
         return ret
 
@@ -139,30 +400,56 @@ class BatchingSql:
             self.db.commit()
             self.todo = []
 
+def flags_match_except(flags, other, *keys):
+    # Check if two sets of abstraction flags are the same, ignoring some keys
+    return {x: y for x, y in flags.items() if x not in keys} == {x: y for x, y in other.items() if x not in keys}
+
 def chunks(values, size):
     for i in range(0, len(values), size):
         yield values[i : i + size]
 
+# Maps each byte value to a lowercase letter
+_HASH_LETTERS = bytes.maketrans(bytes(range(256)), bytes(ord(string.ascii_lowercase[x % 26]) for x in range(256)))
+
+def put_unless_stopped(dest, item, stop):
+    # Put item in the dest queue, waiting for room unless the stop event gets
+    # set, which means whoever reads the queue stopped listening.  Returns True
+    # if the item was put in the queue
+    while not stop.is_set():
+        try:
+            dest.put(item, timeout=0.25)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def hash_name(key, name):
+    # Turn a name into a fake name of 12 to 16 lowercase letters.  The same key
+    # and name always give the same fake name, on any machine or process, and
+    # without the key there's no way to check a guess at the original name,
+    # which is why dir_sizer picks a random key if --hide_key isn't given.
+    # The names are long enough that two different names in the same folder
+    # ending up with the same fake name isn't a concern
+    if len(key) > 64:
+        # BLAKE2 keys are limited in size
+        key = hashlib.sha256(key).digest()
+    digest = hashlib.blake2b(name.encode("utf-8", "surrogateescape"), key=key, digest_size=17).digest()
+    return digest[1:13 + digest[0] % 5].translate(_HASH_LETTERS).decode("ascii")
+
+@functools.lru_cache(maxsize=65536)
+def hide_name(key, name):
+    # The same names show up over and over, like a folder name in the path of
+    # every file under it, so remember the most recent ones
+    return hash_name(key, name)
+
 def hide_value(opts, to_hide):
+    # In this mode, hide all names.  Each name is replaced with a keyed hash of
+    # it, so a name is hidden the same way every time, no matter what order the
+    # names are seen in, or which process sees them
+    key = opts['hide_key']
     if isinstance(to_hide, list):
-        return [hide_value(opts, x) for x in to_hide]
-
-    # In this mode, hide all names, keeping track of the random selections
-    # so we repeat any hidden names
-    if 'hide_history' not in opts:
-        opts['hide_history'] = {}
-        opts['hide_used'] = set()
-        # Seed the random number generator so that run-to-run is the same
-        random.seed(200)
-    
-    if to_hide not in opts['hide_history']:
-        while True:
-            picked = "".join(random.choice(string.ascii_lowercase) for _ in range(random.randint(4, 10)))
-            if picked not in opts['hide_used']:
-                break
-        opts['hide_used'].add(picked)
-        opts['hide_history'][to_hide] = picked
-    return opts['hide_history'][to_hide]
+        return [hide_name(key, x) for x in to_hide]
+    return hide_name(key, to_hide)
 
 if __name__ == "__main__":
     print("This module is not meant to be run directly")